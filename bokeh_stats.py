@@ -1,25 +1,159 @@
 # This script processes the stats.json file created by ookla_data_quadkey_batcher.py and creates a Bokeh visualization of the data
 # as time series charts for Upload, Download, and Latency values.
+# If the batcher's stats store (stats.sqlite, or the file given with --stats-db, as for the batcher; see stats_store.py)
+# is there, only the rows and columns the plots need are read from it; otherwise the stats are read from
+# stats_fixed.json and stats_mobile.json.
+#
+# Each plot is only regenerated when its stats or options change: render-cache.json in data-plots records a key for every
+# plot file, made from a hash of the stats it plots and its options, and a plot whose key hasn't changed is kept as it
+# is. Use --force to regenerate every plot anyway.
+#
+# For scheduled runs, --export-all writes all the plots (download, upload and latency, for fixed and mobile, with and
+# without the Hawaii islands) in one pass, without opening a browser, and --workers N writes them in N processes.
+# --dashboard writes them all to one file instead, data-plots/dashboard.html, with a tab for each service type and set
+# of locations. The plots of a service type share the data of each location, which is only in the dashboard once.
+#
+# --period annual or --period rolling4 plots yearly or rolling four-quarter stats instead of quarterly ones, computed from
+# the aggregates in the stats store (see stats_trends.py), to files and titles marked with the period.
 #
 # It can be called on its own or from the end of the batcher script.
 
-# Note that this script assumes Python 3.6 or higher. Before running this script, you will need to install bokeh and pandas.
+# Note that this script assumes Python 3.9 or higher. Before running this script, you will need to install bokeh and pandas.
 
 import argparse
+import concurrent.futures
+import hashlib
 import json
+import os
 
-from bokeh.models import HoverTool, ColumnDataSource, Label
+from bokeh.layouts import column
+from bokeh.models import HoverTool, ColumnDataSource, Label, TabPanel, Tabs
 from bokeh.palettes import Category10
-from bokeh.plotting import figure, show, output_file
+from bokeh.plotting import figure, show, output_file, save
+from bokeh.util.browser import view
 
 import pandas as pd
 
+from stats_store import read_stats, stats_db_filename
+from stats_trends import store_rollup
+
 # data-plots directory, where the output files will be saved
 output_path = "data-plots"
 
+# The render cache, in output_path: plot filename -> the key of the stats and options it was rendered from
+render_cache_filename = "render-cache.json"
+
+# Bump this whenever the way plots are drawn changes, so the cached plots are regenerated
+render_version = 1
+
+# The combined file written by --dashboard, in output_path
+dashboard_filename = "dashboard.html"
+
+# The three plots of each service type: file name, title, stats column and y axis label
+plot_metrics = [
+    ("download_speeds", "Download Speeds", "download", "Download Speed (Mbps)"),
+    ("upload_speeds", "Upload Speeds", "upload", "Upload Speed (Mbps)"),
+    ("latency", "Latency", "latency", "Latency (ms)"),
+]
+
+# How each --period is named in the plot titles and (except quarter) in the file names
+period_titles = {"quarter": "", "annual": "Annual ", "rolling4": "Rolling 4-Quarter "}
+
+
+def period_suffix(period):
+    return "" if period == "quarter" else "-" + period
+
+
+def load_stats(service_type, json_path, period="quarter", stats_db=stats_db_filename):
+    # The download, upload and latency of every quarter and location, as a dataframe with a date for each quarter,
+    # from the stats store stats_db if it exists, or json_path. For the other periods, which need the store, the date is
+    # the start of the year, or of the last quarter of the rolling window, and a ValueError is raised if the store's
+    # stats can't be rolled up (see store_rollup).
+    if period != "quarter":
+        df = store_rollup(stats_db, service_type, period)
+        df["date"] = pd.PeriodIndex(
+            df["period"], freq="Y" if period == "annual" else "Q"
+        ).to_timestamp()
+        return df[["date", "location", "download", "upload", "latency"]]
+
+    if os.path.exists(stats_db):
+        df = read_stats(
+            stats_db, service_type, columns=["download", "upload", "latency"]
+        )
+        if len(df):
+            df["date"] = pd.PeriodIndex(df["quarter"], freq="Q").to_timestamp()
+            return df[["date", "location", "download", "upload", "latency"]]
+
+    with open(json_path, "r") as f:
+        data = json.load(f)
+
+    # One frame per quarter, with a row per location, and the quarters parsed into dates all at once
+    df = pd.concat(
+        {
+            quarter: pd.DataFrame.from_dict(locations, orient="index")
+            for quarter, locations in data.items()
+        },
+        names=["quarter", "location"],
+    ).reset_index()
+    df["date"] = pd.PeriodIndex(df["quarter"], freq="Q").to_timestamp()
+    return df[["date", "location", "download", "upload", "latency"]]
+
+
+def stats_hash(df):
+    # A hash of the stats in a dataframe, which changes whenever any of them do
+    return hashlib.sha1(
+        pd.util.hash_pandas_object(df, index=False).values.tobytes()
+    ).hexdigest()
+
+
+def load_render_cache():
+    filename = os.path.join(output_path, render_cache_filename)
+    if os.path.exists(filename):
+        with open(filename, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_render_cache(render_cache):
+    with open(os.path.join(output_path, render_cache_filename), "w") as f:
+        json.dump(render_cache, f, indent=1)
+
+
+def render_plot(
+    filename, cache_key, make_plot, render_cache, force=False, headless=False
+):
+    # Write the plot made by make_plot to filename and show it (unless headless), unless filename was already rendered
+    # from the same stats and options, in which case the existing file is shown. render_cache is updated with the key.
+    if (
+        not force
+        and render_cache.get(filename) == cache_key
+        and os.path.exists(filename)
+    ):
+        print("Unchanged:", filename)
+        if not headless:
+            view(filename)
+        return
+    output_file(filename)
+    if headless:
+        save(make_plot())
+        print("Wrote", filename)
+    else:
+        show(make_plot())
+    render_cache[filename] = cache_key
+
+
+def location_sources(df, shared=False):
+    # The data of each location, to plot. Plots in the same file can share ColumnDataSources (shared=True), but a
+    # ColumnDataSource can only be in one file, so otherwise each plot makes its own from the same columns.
+    sources = {}
+    for location, location_data in df.groupby("location", sort=False):
+        columns = ColumnDataSource.from_df(location_data)
+        sources[location] = ColumnDataSource(columns) if shared else columns
+    return sources
+
 
 def generate_time_series_plot(
-    data, title, y_axis_column, x_axis_label, y_axis_label, no_hawaii
+    data, title, y_axis_column, x_axis_label, y_axis_label, no_hawaii, sources=None
 ):
     # Define color groups
     color_groups = {
@@ -86,19 +220,22 @@ def generate_time_series_plot(
         height=600,
     )
 
+    # Split the data up by location once, unless it already has been
+    if sources is None:
+        sources = location_sources(data)
+
     # Iterate over locations based on the predefined order in location_groups
     for location in location_groups.keys():
-        if location in data["location"].unique():
-            # Filter data for each location
-            location_data = data[data["location"] == location]
-
+        if location in sources:
             # Get the group and corresponding color
             group = location_groups[location]
             color = color_groups[group][group_counts[group] % len(color_groups[group])]
             group_counts[group] += 1  # Increment the count for this group
 
-            # Create a ColumnDataSource
-            source = ColumnDataSource(location_data)
+            # Create a ColumnDataSource, or use the shared one
+            source = sources[location]
+            if not isinstance(source, ColumnDataSource):
+                source = ColumnDataSource(dict(source))
 
             # Plot line
             p.line(
@@ -125,43 +262,9 @@ def generate_time_series_plot(
     return p
 
 
-def plot_3(df, stats_class, no_hawaii=False):
-    # File names should indicate whether hawaii is visible
-    if no_hawaii:
-        stub = "hi-state-only"
-    else:
-        stub = "all"
-
-    titlecase_stats_class = stats_class.title()
-
-    # For the single dataframe, df:
-    plot_download = generate_time_series_plot(
-        df,
-        titlecase_stats_class + " Internet Download Speeds Over Time",
-        "download",
-        "Date",
-        "Download Speed (Mbps)",
-        no_hawaii,
-    )
-    plot_upload = generate_time_series_plot(
-        df,
-        titlecase_stats_class + " Internet Upload Speeds Over Time",
-        "upload",
-        "Date",
-        "Upload Speed (Mbps)",
-        no_hawaii,
-    )
-    plot_latency = generate_time_series_plot(
-        df,
-        titlecase_stats_class + " Internet Latency Over Time",
-        "latency",
-        "Date",
-        "Latency (ms)",
-        no_hawaii,
-    )
-
-    # Add a caption for each plot. Note each Label can only belong to one plot.
-    dcaption = Label(
+def caption():
+    # A caption for a plot. Note each Label can only belong to one plot.
+    return Label(
         x=715,
         y=0,
         x_units="screen",
@@ -175,51 +278,127 @@ def plot_3(df, stats_class, no_hawaii=False):
         text_align="right",
     )
 
-    ucaption = Label(
-        x=715,
-        y=0,
-        x_units="screen",
-        y_units="screen",
-        text=" Data: Ookla, Inc. Analysis: Peter Dresslar, PBDE ",
-        text_font_size="9pt",
-        border_line_color="black",
-        border_line_alpha=1.0,
-        background_fill_color="white",
-        background_fill_alpha=1.0,
-        text_align="right",
-    )
 
-    lcaption = Label(
-        x=715,
-        y=0,
-        x_units="screen",
-        y_units="screen",
-        text=" Data: Ookla, Inc. Analysis: Peter Dresslar, PBDE ",
-        text_font_size="9pt",
-        border_line_color="black",
-        border_line_alpha=1.0,
-        background_fill_color="white",
-        background_fill_alpha=1.0,
-        text_align="right",
+def make_plot(df, stats_class, metric, no_hawaii, sources=None, period="quarter"):
+    # One of the plot_metrics for a service type, with its caption
+    name, metric_title, y_axis_column, y_axis_label = metric
+    plot = generate_time_series_plot(
+        df,
+        stats_class.title()
+        + " Internet "
+        + period_titles[period]
+        + metric_title
+        + " Over Time",
+        y_axis_column,
+        "Date",
+        y_axis_label,
+        no_hawaii,
+        sources,
     )
+    plot.add_layout(caption())
+    return plot
+
+
+def plot_3(
+    df,
+    stats_class,
+    no_hawaii=False,
+    render_cache=None,
+    force=False,
+    headless=False,
+    sources=None,
+    period="quarter",
+):
+    # File names should indicate whether hawaii is visible, and the period if it isn't quarters
+    if no_hawaii:
+        stub = "hi-state-only"
+    else:
+        stub = "all"
+    stub += period_suffix(period)
+
+    # Without a render cache, the plots are always written
+    if render_cache is None:
+        render_cache = {}
+    df_hash = stats_hash(df)
+
+    # For the single dataframe, df: output the download, upload and latency plots to HTML files in our output_path,
+    # unless they're unchanged
+    for metric in plot_metrics:
+        cache_key = hashlib.sha1(
+            json.dumps(
+                [render_version, df_hash, stats_class, metric, no_hawaii, period]
+            ).encode()
+        ).hexdigest()
+        render_plot(
+            f"{output_path}/{stats_class}-internet_{metric[0]}-{stub}.html",
+            cache_key,
+            lambda metric=metric: make_plot(
+                df, stats_class, metric, no_hawaii, sources, period
+            ),
+            render_cache,
+            force,
+            headless,
+        )
 
-    plot_download.add_layout(dcaption)
-    plot_upload.add_layout(ucaption)
-    plot_latency.add_layout(lcaption)
 
-    # Output the plots to HTML files, using our output_path
-    output_file(
-        output_path + "/" + stats_class + "-internet_download_speeds-" + stub + ".html"
-    )
-    show(plot_download)
+def export_plots(df, stats_class, render_cache, force=False, period="quarter"):
+    # Write all six plots of a service type (with and without the Hawaii islands) without opening a browser, splitting
+    # the data up by location only once. Returns the render cache entries of the plots that were written, so the
+    # entries from several workers can be merged.
+    service_render_cache = dict(render_cache)
+    sources = location_sources(df)
+    for no_hawaii in [False, True]:
+        plot_3(
+            df,
+            stats_class,
+            no_hawaii,
+            service_render_cache,
+            force,
+            True,
+            sources,
+            period,
+        )
+    return {
+        filename: cache_key
+        for filename, cache_key in service_render_cache.items()
+        if render_cache.get(filename) != cache_key
+    }
 
-    output_file(
-        output_path + "/" + stats_class + "-internet_upload_speeds-" + stub + ".html"
-    )
-    show(plot_upload)
 
-    output_file(output_path + "/" + stats_class + "-internet_latency-" + stub + ".html")
-    show(plot_latency)
+def export_dashboard(dfs, render_cache, force=False, period="quarter"):
+    # Write the plots of every service type in dfs to one file, in a tab for each service type and set of locations.
+    # The plots of a service type share one ColumnDataSource per location.
+    cache_key = hashlib.sha1(
+        json.dumps(
+            [render_version, period]
+            + [[stats_class, stats_hash(df)] for stats_class, df in dfs.items()]
+        ).encode()
+    ).hexdigest()
+
+    def make_dashboard():
+        tabs = []
+        for stats_class, df in dfs.items():
+            sources = location_sources(df, shared=True)
+            for no_hawaii in [False, True]:
+                plots = [
+                    make_plot(df, stats_class, metric, no_hawaii, sources, period)
+                    for metric in plot_metrics
+                ]
+                title = stats_class.title() + (
+                    " (hi-state-only)" if no_hawaii else " (all)"
+                )
+                tabs.append(TabPanel(child=column(plots), title=title))
+        return Tabs(tabs=tabs)
+
+    name, extension = os.path.splitext(dashboard_filename)
+    render_plot(
+        f"{output_path}/{name}{period_suffix(period)}{extension}",
+        cache_key,
+        make_dashboard,
+        render_cache,
+        force,
+        headless=True,
+    )
 
 
 if __name__ == "__main__":
@@ -240,65 +419,116 @@ if __name__ == "__main__":
         help="Plot fixed, mobile, or all data.",
     )
 
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate every plot, even if its stats haven't changed.",
+    )
+
+    # args for headless runs, e.g. from a scheduled pipeline
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="Write the plots without opening them in a browser.",
+    )
+    parser.add_argument(
+        "--export-all",
+        action="store_true",
+        help="Write the plots with and without the Hawaii islands in one headless run.",
+    )
+    parser.add_argument(
+        "--dashboard",
+        action="store_true",
+        help="Write all the plots to one file, dashboard.html, in one headless run.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="With --export-all, write the plots of each service type in a separate process.",
+    )
+    parser.add_argument(
+        "--period",
+        default="quarter",
+        choices=["quarter", "annual", "rolling4"],
+        help="Plot quarterly, annual or rolling four-quarter stats (annual and rolling4 need the stats store).",
+    )
+    parser.add_argument(
+        "--stats-db",
+        default=stats_db_filename,
+        help="The batcher's SQLite stats store (see stats_store.py), read instead of the json files if it exists.",
+    )
+
     # Parse the arguments
     args = parser.parse_args()
     no_hawaii_islands = args.no_hawaii_islands
 
     stats_class = args.stats_class
 
-    print(f"Plotting data for Hawaii Islands: {not no_hawaii_islands}")
-
-    # Import data from stats.json
+    # Import data from the stats store, or stats.json
     # We will process stats_fixed.json, stats_mobile.json, or both, so we have a bit of control logic...
     fixed_path = "stats_fixed.json"
     mobile_path = "stats_mobile.json"
-
-    if args.stats_class == "all" or args.stats_class == "mobile":
-        with open(mobile_path, "r") as f:
-            data = json.load(f)
-
-        rows = []
-        for quarter, locations in data.items():
-            for location, values in locations.items():
-                rows.append(
-                    [
-                        pd.to_datetime(quarter),
-                        location,
-                        values["download"],
-                        values["upload"],
-                        values["latency"],
-                    ]
-                )
-
-        df = pd.DataFrame(
-            rows, columns=["date", "location", "download", "upload", "latency"]
-        )
-        print(df.head(20))
-
-        # Now plot the three timeseries
-        plot_3(df, "mobile", no_hawaii_islands)
-
-    if args.stats_class == "all" or args.stats_class == "fixed":
-        with open(fixed_path, "r") as f:
-            data = json.load(f)
-
-        rows = []
-        for quarter, locations in data.items():
-            for location, values in locations.items():
-                rows.append(
-                    [
-                        pd.to_datetime(quarter),
-                        location,
-                        values["download"],
-                        values["upload"],
-                        values["latency"],
-                    ]
+    json_paths = {"mobile": mobile_path, "fixed": fixed_path}
+    stats_classes = ["mobile", "fixed"] if stats_class == "all" else [stats_class]
+    if args.period != "quarter" and not os.path.exists(args.stats_db):
+        parser.error(f"--period {args.period} needs the stats store, {args.stats_db}")
+
+    # Load every service type's stats before writing any plots, so missing stats don't leave empty plots behind (or in
+    # the render cache)
+    try:
+        dfs = {
+            stats_class: load_stats(
+                stats_class, json_paths[stats_class], args.period, args.stats_db
+            )
+            for stats_class in stats_classes
+        }
+    except ValueError as e:
+        parser.error(str(e))
+    for stats_class, df in dfs.items():
+        if not len(df):
+            parser.error(f"There are no {stats_class} stats to plot")
+
+    render_cache = load_render_cache()
+
+    if args.export_all or args.dashboard:
+        if args.export_all and args.workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+                futures = [
+                    executor.submit(
+                        export_plots,
+                        df,
+                        stats_class,
+                        render_cache,
+                        args.force,
+                        args.period,
+                    )
+                    for stats_class, df in dfs.items()
+                ]
+                for future in futures:
+                    render_cache.update(future.result())
+        elif args.export_all:
+            for stats_class, df in dfs.items():
+                render_cache.update(
+                    export_plots(df, stats_class, render_cache, args.force, args.period)
                 )
+        if args.dashboard:
+            export_dashboard(dfs, render_cache, args.force, args.period)
+    else:
+        print(f"Plotting data for Hawaii Islands: {not no_hawaii_islands}")
+
+        for stats_class, df in dfs.items():
+            print(df.head(20))
+
+            # Now plot the three timeseries
+            plot_3(
+                df,
+                stats_class,
+                no_hawaii_islands,
+                render_cache,
+                args.force,
+                args.headless,
+                period=args.period,
+            )
 
-        df = pd.DataFrame(
-            rows, columns=["date", "location", "download", "upload", "latency"]
-        )
-        print(df.head(20))
-
-        # Now plot the three timeseries
-        plot_3(df, "fixed", no_hawaii_islands)
+    save_render_cache(render_cache)
@@ -0,0 +1,99 @@
+# Fast GeoJSON writer for the batcher's per-location output files.
+#
+# GeoDataFrame.to_file goes through GDAL one feature at a time, and sets up the driver on every call, which adds up
+# over every location, service type and quarter. This writer serializes a whole GeoDataFrame at once instead:
+# the properties with pandas' (C) JSON writer, and the geometries with shapely.to_geojson (GEOS), and then just joins
+# the strings together. It is several times faster than to_file on large files, and the output has the same layout as
+# GDAL's GeoJSON driver: a header with the collection's name and CRS, then one feature per line.
+#
+# Coordinates are written as the shortest decimals that read back as the same floats (Python's repr, e.g.
+# 21.33031507343179), up to 17 significant digits, while GDAL writes 15, so the two can differ in the last digits.
+# Pass precision to round them to that many decimal places, which makes the files smaller (6 decimal places is about
+# 10 cm).
+#
+# GeoJSONStreamWriter can also write a FeatureCollection a few features at a time, for the batcher's --stream mode:
+# each call to write() appends the features of another GeoDataFrame, so a location's tiles never have to be in memory
+# together, and write_lines() appends features that were already serialized, so tiles that go in several files only
+# have to be serialized once. The file is written under a temporary name and only renamed into place by close(), so a
+# failed run never leaves a half-written file behind.
+
+import json
+import os
+
+import geopandas as gp
+import numpy as np
+import shapely
+
+# GDAL writes this CRS for EPSG:4326 (lon/lat) data
+crs84 = {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}}
+
+
+def feature_lines(tiles: gp.GeoDataFrame, precision: int = None) -> list:
+    # Serialize every row of tiles to a GeoJSON Feature, one string per row
+    if not len(tiles):
+        return []
+    # Missing values become null, like to_file
+    properties = (
+        tiles.drop(columns=tiles.geometry.name)
+        .to_json(orient="records", lines=True)
+        .splitlines()
+    )
+    geometries = tiles.geometry.values
+    if precision is not None:
+        geometries = shapely.transform(
+            geometries, lambda coordinates: np.round(coordinates, precision)
+        )
+    geometries = shapely.to_geojson(geometries)
+    return [
+        f'{{"type": "Feature", "properties": {row_properties}, "geometry": {geometry or "null"}}}'
+        for row_properties, geometry in zip(properties, geometries)
+    ]
+
+
+class GeoJSONStreamWriter:
+    def __init__(self, filename: str, precision: int = None):
+        self.filename = filename
+        self.tmp_filename = filename + ".tmp"
+        self.precision = precision
+        self.file = open(self.tmp_filename, "w")
+        self.count = 0
+        name = os.path.splitext(os.path.basename(filename))[0]
+        self.file.write(
+            '{\n"type": "FeatureCollection",\n'
+            f'"name": {json.dumps(name)},\n'
+            f'"crs": {json.dumps(crs84)},\n'
+            '"features": [\n'
+        )
+
+    def write(self, tiles: gp.GeoDataFrame):
+        self.write_lines(feature_lines(tiles, self.precision))
+
+    def write_lines(self, lines: list):
+        # Append features already serialized by feature_lines, e.g. to write the same tiles to several files
+        if not lines:
+            return
+        if self.count:
+            self.file.write(",\n")
+        self.file.write(",\n".join(lines))
+        self.count += len(lines)
+
+    def close(self):
+        self.file.write("\n]\n}\n")
+        self.file.close()
+        os.replace(self.tmp_filename, self.filename)
+
+    def abort(self):
+        # Give up on the file, e.g. because reading the tiles failed
+        self.file.close()
+        os.remove(self.tmp_filename)
+
+
+def write_geojson(tiles: gp.GeoDataFrame, filename: str, precision: int = None):
+    # Write all of tiles to filename; the fast equivalent of tiles.to_file(filename, driver="GeoJSON")
+    writer = GeoJSONStreamWriter(filename, precision)
+    try:
+        writer.write(tiles)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
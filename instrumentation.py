@@ -0,0 +1,174 @@
+# Timing and memory instrumentation for ookla_data_quadkey_batcher.py (--trace and --profile).
+#
+# A Tracer records spans: named, timed stages of the work, like downloading a quarter, parsing it, or writing one
+# location's geojson file. Every span records
+#   seconds       wall time
+#   cpu_seconds   CPU time of the thread that ran it
+#   rss_mb        resident memory of this process at the end of the span
+#   rss_delta_mb  how much that grew (or shrank) during the span: the memory the stage allocated and kept, e.g. the
+#                 tiles it read. Spans that run at the same time on other threads (the output threads) count in it too.
+#   max_rss_mb    peak resident memory of this process so far, at the end of the span. This is a high-water mark over
+#                 the life of the process, not the span's own peak, so after the biggest quarter it stays the same.
+#   rows          the number of tiles the stage handled, if it sets one (each tile once, even if it's in overlapping
+#                 locations)
+# along with any attributes it was given (e.g. service, quarter and location), and is written to the trace file as
+# soon as it ends, so a long run can be watched while it goes, and a crashed run still leaves its trace behind.
+#
+# The trace file is either JSON lines (one span per line, easy to load with pandas.read_json(lines=True)), or the
+# Chrome trace event format, which can be loaded into chrome://tracing, https://ui.perfetto.dev or speedscope to see
+# the spans on a timeline. Worker processes append to the same file, and show up as separate processes in the viewer,
+# and the output threads (see output_stage.py) as separate threads.
+#
+# The current RSS comes from /proc/self/statm on Linux, or psutil if it's installed; without either, rss_mb and
+# rss_delta_mb are null.
+#
+# profiled() wraps a piece of work in cProfile and saves the profile, for use with python -m pstats or snakeviz.
+# For a sampling profiler, run the batcher under py-spy instead, e.g. py-spy record -o profile.svg -- python ...
+
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Optional: only used for the current RSS where there's no /proc
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+trace_formats = ["jsonl", "chrome"]
+
+
+def max_rss_mb(who=None) -> float:
+    # Peak resident memory of this process (or its children) so far, in MB. ru_maxrss is in KB on Linux, bytes on macOS.
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    return rss / 1024**2 if sys.platform == "darwin" else rss / 1024
+
+
+def rss_mb() -> float:
+    # Resident memory of this process right now, in MB, or None if we can't tell
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError, AttributeError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024**2
+    return None
+
+
+class Span:
+    # One timed stage. Set rows (or add to attributes) inside the with block to record them.
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.rows = None
+        self.thread = threading.get_native_id()
+
+    def __enter__(self):
+        self.start = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.thread_time()
+        self.start_rss_mb = rss_mb()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start_wall
+        self.cpu_seconds = time.thread_time() - self.start_cpu
+        self.rss_mb = rss_mb()
+        self.rss_delta_mb = (
+            self.rss_mb - self.start_rss_mb if self.rss_mb is not None else None
+        )
+        self.max_rss_mb = max_rss_mb()
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "start": self.start,
+            "seconds": self.seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "rss_mb": self.rss_mb,
+            "rss_delta_mb": self.rss_delta_mb,
+            "max_rss_mb": self.max_rss_mb,
+            "rows": self.rows,
+            "pid": os.getpid(),
+            "thread": self.thread,
+            **self.attributes,
+        }
+
+
+class Tracer:
+    # Writes spans to trace_filename. With no trace_filename, spans are still timed but not written anywhere.
+    def __init__(self, trace_filename: str = None, trace_format: str = "jsonl"):
+        if trace_format not in trace_formats:
+            raise ValueError(f"Trace format must be one of {trace_formats}")
+        self.trace_filename = trace_filename
+        self.trace_format = trace_format
+
+    def start(self):
+        # Start a new trace file. Only the main process calls this; workers just append to the file.
+        if self.trace_filename is None:
+            return
+        with open(self.trace_filename, "w") as f:
+            # The Chrome format is a JSON array, but viewers accept it without the closing bracket,
+            # which lets every process append its events as they happen.
+            if self.trace_format == "chrome":
+                f.write("[\n")
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        span = Span(name, attributes)
+        with span:
+            yield span
+        self._write(span)
+
+    def _write(self, span: Span):
+        if self.trace_filename is None:
+            return
+        record = span.to_dict()
+        if self.trace_format == "chrome":
+            # A "complete" event, with times in microseconds. Spans nest by time, so a quarter's stages show up
+            # under the quarter.
+            line = json.dumps(
+                {
+                    "name": record.pop("name"),
+                    "ph": "X",
+                    "ts": int(record.pop("start") * 1e6),
+                    "dur": int(record.pop("seconds") * 1e6),
+                    "pid": record.pop("pid"),
+                    "tid": record.pop("thread"),
+                    "args": record,
+                }
+            )
+            line += ",\n"
+        else:
+            line = json.dumps(record) + "\n"
+        # One write per span in append mode, so the lines of different processes don't get mixed up
+        with open(self.trace_filename, "a") as f:
+            f.write(line)
+
+
+@contextlib.contextmanager
+def profiled(profile_filename: str = None):
+    # Run the with block under cProfile and save the stats to profile_filename. With no filename, do nothing.
+    if profile_filename is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_filename)
+        print("Wrote profile", profile_filename)
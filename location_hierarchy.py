@@ -0,0 +1,157 @@
+# Hierarchies of the locations in island_quadkeys.json, for the batcher's --location-hierarchy.
+#
+# Some locations contain others: hawaii-state's quadkey prefixes cover oahu, maui, kauai and the rest of the islands,
+# so without a hierarchy every Hawaii tile is located, aggregated and written out twice, once for its island and once
+# for the state. A location is inside another when every one of its prefixes starts with one of the other's prefixes,
+# so the hierarchy is detected from the prefixes alone, and nothing has to be declared in island_quadkeys.json:
+#   children    the locations directly inside a location (not inside another of its children), as long as they don't
+#               overlap each other. A location with children is a parent, e.g. hawaii-state.
+#   remainder   the rest of a parent, outside its children (e.g. the sea around the islands), as quadkey prefixes that
+#               don't overlap the children's, so every tile of the parent is in exactly one child or its remainder
+#   pieces      every location that isn't a parent, and the remainders of the parents
+# The batcher locates and aggregates just the pieces, and a parent's stats are the merge of its pieces' TileStats (see
+# tile_stats.py). Its output files are written from the same serialized tiles as its children's files (see
+# ookla_data_quadkey_batcher.py), so a tile is only ever aggregated and serialized once.
+#
+# The merged stats are the same as a parent's own, except that its means can differ in the last digit or so, since the
+# tiles are added up in a different order.
+
+# The name of a parent's remainder piece
+remainder_format = "{} (rest)"
+
+
+def inside(prefixes: list, other_prefixes: list) -> bool:
+    # Whether every quadkey starting with one of prefixes also starts with one of other_prefixes
+    return all(
+        any(prefix.startswith(other) for other in other_prefixes) for prefix in prefixes
+    )
+
+
+def overlap(prefixes: list, other_prefixes: list) -> bool:
+    # Whether any quadkey can start with both one of prefixes and one of other_prefixes
+    return any(
+        prefix.startswith(other) or other.startswith(prefix)
+        for prefix in prefixes
+        for other in other_prefixes
+    )
+
+
+def subtract_prefixes(prefixes: list, other_prefixes: list) -> list:
+    # The quadkeys that start with one of prefixes but none of other_prefixes, as prefixes: each prefix that has some
+    # of other_prefixes inside it is split into its four child tiles, until they are either inside or clear of them.
+    remainder = []
+    for prefix in prefixes:
+        if any(prefix.startswith(other) for other in other_prefixes):
+            continue
+        within = [other for other in other_prefixes if other.startswith(prefix)]
+        if within:
+            remainder.extend(
+                subtract_prefixes([prefix + digit for digit in "0123"], within)
+            )
+        else:
+            remainder.append(prefix)
+    return remainder
+
+
+class LocationHierarchy:
+    def __init__(self, location_quadkeys: dict):
+        self.location_quadkeys = location_quadkeys
+        # The locations strictly inside each location
+        contained = {
+            location: [
+                other
+                for other, other_prefixes in location_quadkeys.items()
+                if other != location
+                and inside(other_prefixes, prefixes)
+                and not inside(prefixes, other_prefixes)
+            ]
+            for location, prefixes in location_quadkeys.items()
+        }
+        # parent -> children, and child -> parent. A location inside two parents that aren't inside each other only
+        # goes to the first, and the other is left as a piece of its own.
+        self.children = {}
+        self.parents = {}
+        for location in sorted(location_quadkeys):
+            children = [
+                child
+                for child in contained[location]
+                if not any(child in contained[other] for other in contained[location])
+            ]
+            if (
+                children
+                and not any(child in self.parents for child in children)
+                and not any(
+                    overlap(location_quadkeys[child], location_quadkeys[other])
+                    for i, child in enumerate(children)
+                    for other in children[i + 1 :]
+                )
+            ):
+                self.children[location] = children
+                for child in children:
+                    self.parents[child] = location
+
+        # piece -> prefixes, for the LocationIndex
+        self.pieces = {}
+        for location, prefixes in location_quadkeys.items():
+            if location not in self.children:
+                self.pieces[location] = prefixes
+                continue
+            remainder = subtract_prefixes(
+                prefixes,
+                [
+                    prefix
+                    for child in self.children[location]
+                    for prefix in location_quadkeys[child]
+                ],
+            )
+            if remainder:
+                self.pieces[remainder_format.format(location)] = remainder
+
+    def members(self, location: str) -> list:
+        # The pieces that make up a location
+        if location not in self.children:
+            return [location]
+        members = [
+            piece for child in self.children[location] for piece in self.members(child)
+        ]
+        if remainder_format.format(location) in self.pieces:
+            members.append(remainder_format.format(location))
+        return members
+
+    def family(self, location: str) -> list:
+        # A location and all the locations below it
+        return [location] + [
+            member
+            for child in self.children.get(location, [])
+            for member in self.family(child)
+        ]
+
+    def roots(self) -> list:
+        # The locations that aren't the children of a parent, which together with their families are all the locations
+        return [
+            location
+            for location in self.location_quadkeys
+            if location not in self.parents
+        ]
+
+    def piece_locations(self, locations: list = None) -> dict:
+        # piece -> the locations it's part of (itself, if it's a location, and its parents), for all or some locations
+        piece_locations = {}
+        for location in self.location_quadkeys if locations is None else locations:
+            for piece in self.members(location):
+                piece_locations.setdefault(piece, []).append(location)
+        return piece_locations
+
+    def merge_stats(self, piece_stats: dict) -> dict:
+        # The TileStats of every location, from those of the pieces (piece -> TileStats)
+        from tile_stats import TileStats
+
+        location_stats = {}
+        for location in self.location_quadkeys:
+            if location in self.children:
+                location_stats[location] = TileStats()
+                for piece in self.members(location):
+                    location_stats[location].merge(piece_stats[piece])
+            else:
+                location_stats[location] = piece_stats[location]
+        return location_stats
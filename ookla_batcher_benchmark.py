@@ -0,0 +1,244 @@
+# This script benchmarks the batcher (ookla_data_quadkey_batcher.py) on synthetic data of different sizes, so that we
+# can see how it scales, and catch performance regressions between versions.
+#
+# For each size, it creates a synthetic Ookla file (see ookla_synthetic_data_creator.py; the files are kept in
+# --data-dir and reused), and runs the whole batcher end to end on it, in a scratch directory, recording its wall time
+# and peak RSS. Use --batcher-args to pass it extra arguments, e.g. --batcher-args="--stream".
+# The batcher runs with --trace (see instrumentation.py), and the time of each stage is added up from the spans in its
+# trace, so the stages are timed exactly as the batcher ran them:
+#   download   fetching the file into the cache (only with --cache-dir in --batcher-args)
+#   parse      reading the tiles (with the download, without a cache)
+#   filter     LocationIndex.locate
+#   aggregate  TileStats for every location
+#   write      the output files of every location (on the output threads, so these can overlap the other stages)
+#   quarter    the whole quarter
+# For each stage we record the wall and CPU time of its spans, added up, the number of rows they handled, the most
+# that the batcher's RSS grew during one of them (rss_delta_mb, see instrumentation.py), and the batcher's peak RSS at
+# the end of the last of them (a high-water mark, so it's the same for every stage after the biggest one).
+# The results are written to a JSON report (--report). Pass an earlier report with --compare to see how the times
+# have changed; stages that got more than --threshold times slower are flagged. Results that were run with different
+# --batcher-args are shown but not flagged, since they aren't comparable.
+#
+# To run this script from the command line:
+# python ookla_batcher_benchmark.py --sizes 10000 100000 1000000 --report benchmark-report.json
+# python ookla_batcher_benchmark.py --sizes 10000 100000 1000000 --compare benchmark-report.json
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import geopandas as gp
+
+from instrumentation import max_rss_mb, resource
+from ookla_synthetic_data_creator import make_tiles, mirror_path, write_zipped_shapefile
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+batcher_script = os.path.join(script_dir, "ookla_data_quadkey_batcher.py")
+
+# The synthetic files are all written as this service type and quarter
+bench_service, bench_year, bench_quarter = "fixed", 2021, 1
+
+
+def synthetic_file(data_dir: str, tiles: int, seed: int, location_quadkeys: dict):
+    # Create (or reuse) the synthetic file for this size, in a copy of the bucket layout
+    mirror_dir = os.path.join(data_dir, f"tiles-{tiles}-seed-{seed}")
+    path = mirror_path(mirror_dir, bench_service, bench_year, bench_quarter)
+    if not os.path.exists(path):
+        print("Creating", tiles, "synthetic tiles in", path)
+        write_zipped_shapefile(make_tiles(tiles, location_quadkeys, seed), path)
+    return mirror_dir, path
+
+
+def trace_stages(trace_filename: str) -> dict:
+    # Add up the spans of each stage in a JSON lines trace from the batcher
+    stages = {}
+    with open(trace_filename) as f:
+        for line in f:
+            span = json.loads(line)
+            stage = stages.setdefault(
+                span["name"],
+                {
+                    "seconds": 0.0,
+                    "cpu_seconds": 0.0,
+                    "rss_delta_mb": None,
+                    "max_rss_mb": None,
+                    "rows": 0,
+                },
+            )
+            stage["seconds"] += span["seconds"]
+            stage["cpu_seconds"] += span["cpu_seconds"]
+            if span.get("rss_delta_mb") is not None:
+                stage["rss_delta_mb"] = max(
+                    span["rss_delta_mb"],
+                    stage["rss_delta_mb"]
+                    if stage["rss_delta_mb"] is not None
+                    else -1e9,
+                )
+            if span["max_rss_mb"] is not None:
+                stage["max_rss_mb"] = max(stage["max_rss_mb"] or 0, span["max_rss_mb"])
+            stage["rows"] += span["rows"] or 0
+    for name, stage in stages.items():
+        print(f"  {name}: {stage['seconds']:.3f}s")
+    return stages
+
+
+def benchmark_end_to_end(mirror_dir: str, batcher_args: list) -> tuple:
+    # Run the whole batcher on the synthetic file, in a scratch directory so the real stats files aren't touched, and
+    # return its end to end results and its stages
+    with tempfile.TemporaryDirectory() as work_dir:
+        trace_filename = os.path.join(work_dir, "trace.jsonl")
+        shutil.copy(os.path.join(script_dir, "island_quadkeys.json"), work_dir)
+        os.makedirs(os.path.join(work_dir, "geojson-datasets", bench_service))
+        command = (
+            [
+                sys.executable,
+                batcher_script,
+                "--base-url",
+                "file://" + os.path.abspath(mirror_dir),
+                "--start_year",
+                str(bench_year),
+                "--start_quarter",
+                str(bench_quarter),
+                "--end_year",
+                str(bench_year),
+                "--end_quarter",
+                str(bench_quarter),
+            ]
+            + batcher_args
+            + ["--trace", trace_filename, "--trace-format", "jsonl"]
+        )
+        print("  running", " ".join(command[1:]))
+        start = time.perf_counter()
+        completed = subprocess.run(
+            command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        seconds = time.perf_counter() - start
+        if completed.returncode:
+            print(completed.stderr.decode(), file=sys.stderr)
+            raise RuntimeError(
+                f"The batcher failed with exit code {completed.returncode}"
+            )
+        stages = trace_stages(trace_filename)
+    print(f"  end to end: {seconds:.3f}s")
+    # The peak RSS of our children is the peak of the largest one so far. The sizes run smallest first,
+    # so that is this run's.
+    end_to_end = {
+        "seconds": seconds,
+        "max_rss_mb": max_rss_mb(resource.RUSAGE_CHILDREN if resource else None),
+        "args": batcher_args,
+    }
+    return end_to_end, stages
+
+
+def git_commit() -> str:
+    try:
+        return (
+            subprocess.run(
+                ["git", "rev-parse", "HEAD"],
+                cwd=script_dir,
+                capture_output=True,
+                text=True,
+            ).stdout.strip()
+            or None
+        )
+    except OSError:
+        return None
+
+
+def compare(report: dict, previous: dict, threshold: float):
+    # Print how each stage's time changed since the previous report
+    previous_results = {result["tiles"]: result for result in previous["results"]}
+    print(f"Compared with {previous.get('commit')} ({previous.get('created')}):")
+    for result in report["results"]:
+        before = previous_results.get(result["tiles"])
+        if before is None:
+            continue
+        # Different batcher arguments run differently, so a slower time isn't a regression
+        comparable = (result.get("end_to_end") or {}).get("args") == (
+            before.get("end_to_end") or {}
+        ).get("args")
+        timings = dict(result["stages"], end_to_end=result.get("end_to_end"))
+        before_timings = dict(before["stages"], end_to_end=before.get("end_to_end"))
+        for name, timing in timings.items():
+            if not timing or not before_timings.get(name):
+                continue
+            ratio = timing["seconds"] / max(before_timings[name]["seconds"], 1e-9)
+            if not comparable:
+                flag = "  (different --batcher-args)"
+            elif ratio > threshold:
+                flag = "  REGRESSION"
+            else:
+                flag = ""
+            print(
+                f"  {result['tiles']:>10} tiles {name:>10}: {before_timings[name]['seconds']:.3f}s -> {timing['seconds']:.3f}s ({ratio:.2f}x){flag}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Ookla batcher.")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10000, 100000],
+        help="Numbers of synthetic tiles to benchmark with, e.g. 10000 100000 1000000 10000000.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--data-dir",
+        default="benchmark-data",
+        help="Where to keep the synthetic files between runs.",
+    )
+    parser.add_argument("--report", default="benchmark-report.json")
+    parser.add_argument("--compare", default=None, help="An earlier report.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="Flag stages that got this many times slower than in --compare.",
+    )
+    parser.add_argument(
+        "--batcher-args",
+        default="",
+        help="Extra arguments for the end to end batcher run, e.g. '--stream'.",
+    )
+    args = parser.parse_args()
+
+    with open(os.path.join(script_dir, "island_quadkeys.json")) as f:
+        location_quadkeys = json.load(f)
+
+    report = {
+        "created": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "geopandas": gp.__version__,
+        "results": [],
+    }
+    for tiles in sorted(args.sizes):
+        mirror_dir, path = synthetic_file(
+            args.data_dir, tiles, args.seed, location_quadkeys
+        )
+        print("Benchmarking", tiles, "tiles")
+        end_to_end, stages = benchmark_end_to_end(
+            mirror_dir, shlex.split(args.batcher_args)
+        )
+        report["results"].append(
+            {"tiles": tiles, "stages": stages, "end_to_end": end_to_end}
+        )
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=1)
+    print("Wrote", args.report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f), args.threshold)
@@ -8,15 +8,25 @@
 # Our locations are defined in the file island_quadkeys.json.
 #
 # This script processes large files, and geopandas is memory intensive. Expect processing to take many minutes per file in most desktop environments.
+# To keep memory down, the tiles are read with a spatial filter built from the location quadkeys, so only the tiles near our locations are loaded.
 
 # The stats data structure is as follows:
 #   quarter-year
 #       territory
-#           download
-#           upload
-#           latency
+#           download            (mean of the tiles, Mbps)
+#           upload              (mean of the tiles, Mbps)
+#           latency             (mean of the tiles, ms)
 #           tests
 #           devices
+#           tiles
+#           download_weighted   (mean weighted by the tiles' tests; likewise upload_weighted and latency_weighted)
+#           download_median     (median weighted by the tiles' tests; likewise upload_median and latency_median)
+# The stats are computed by TileStats (see tile_stats.py), which can be merged across batches, workers and locations.
+# The stats are kept in an SQLite store (--stats-db, stats.sqlite by default; see stats_store.py), with a row for every
+# service type, quarter and location. Each row also has the TileStats behind the stats, so they can be merged later
+# (e.g. into the annual and rolling stats of stats_trends.py) without reading the tiles again. Every processed quarter
+# is saved to the store as soon as it's done, and at the end of the batch the stats are exported to stats_fixed.json and
+# stats_mobile.json, in the structure above. Stats files from earlier versions are imported into the store the first time it's used.
 
 # To run this script from the command line, use the following command:
 # python ookla_data_quadkey_batcher.py
@@ -28,16 +38,80 @@
 # Or you can use the defaults, which will process all available data based upon today's date.
 # You can also specify whether to process mobile or fixed internet service data.
 # --mobile will process mobile data, otherwise the script will process fixed internet service data.
+# --service both processes fixed and mobile data in one run, sharing the setup (locations, location index, worker pool)
+# between them. Either way, the stats of both service types are also saved together in stats_combined.json.
+# --cache-dir (e.g., ookla-cache) keeps the downloaded quarterly files in a local cache, so later runs over the same quarters skip the download.
+# Use --cache-max-gb to cap the size of the cache (least recently used files are evicted), and --cache-verify to re-check cached files' checksums.
+# --prefetch N (with --cache-dir) downloads up to N of the next quarters' files into the cache in the background, while
+# the current quarter is processed (see prefetch.py).
+# --workers N processes N quarters at once in separate processes, each logging to its own file in --log-dir.
+# The number of workers is limited to what fits in available memory, at --worker-memory-gb per worker.
+# --incremental only processes the quarters and locations that are missing from the stats store, or whose inputs changed.
+# It uses the manifest in the stats store, which records for every quarter and location the input file, the location's
+# quadkeys, and the stats_version of this script that produced the stats.
+# --tile-store (e.g., tile-store) also saves each location's tiles to a GeoParquet store, partitioned by service type, quarter and location.
+# GeoJSON can then be generated from the store with tile_store.py, and --skip-geojson skips writing it here.
+# --pyramid-levels (e.g. 14 12 10) also writes each location's tiles rolled up to lower zoom levels, for web maps, to
+# {location}_ookla_{year}Q{quarter}_z{level}.geojson, with test-weighted speeds and latency (see tile_pyramid.py).
+# --stream reads each quarter in batches of --batch-size tiles instead of all at once, so memory use depends on the batch size
+# rather than on the size of the Ookla file. The stats and output files are the same either way.
+# --geometry-from-quadkeys reads only the tiles' attribute columns, not their polygons, which is much faster, since
+# parsing the polygons is most of the work of reading the file. Every tile's polygon is the square of its quadkey, so
+# the polygons are built from the quadkeys instead, and only for the tiles that are written out (none, with
+# --skip-geojson and no --tile-store). Without the polygons there is no spatial filter, so the whole file is read, and
+# the tiles outside our locations are dropped as it's read, a batch of --batch-size tiles at a time.
+# --location-hierarchy detects the locations that are inside others (e.g. oahu and maui in hawaii-state) from their
+# quadkeys (see location_hierarchy.py). Only the innermost locations, and the rest of the locations around them, are
+# located and aggregated; the stats of the containing locations are merged from theirs, and their files are written
+# from the same serialized tiles, so no tile is aggregated or serialized twice.
+# Every quarter is committed to the stats store as soon as its files are written (by the output thread that writes the
+# last of them, even while the next quarter is being read), and the batch's checkpoint
+# (--checkpoint, batch-checkpoint.json by default) records which of its quarters are committed, until the batch finishes.
+# If a batch is interrupted (a crash, running out of memory, Ctrl-C), or some of its quarters failed,
+# python ookla_data_quadkey_batcher.py --resume
+# continues it with the same arguments and quarters, skipping the quarters that were already committed, and removes any
+# half-written .tmp files the interrupted batch left behind (every output file is written under a .tmp name first).
+# --trace FILE records how long each stage (download, parse, filter, aggregate, write) takes for every quarter and
+# location, with its CPU time, peak memory and number of tiles, as JSON lines or (--trace-format chrome) as a trace
+# that can be viewed in chrome://tracing or https://ui.perfetto.dev. See instrumentation.py.
+# --profile DIR runs each quarter under cProfile, and saves the profile to DIR.
+# Each location's output files are written by --output-threads background threads (see output_stage.py), while the next
+# quarter is processed. The geojson files are written by a fast writer (see geojson_writer.py); use --geojson-precision
+# to round their coordinates to fewer decimal places.
 # There are a couple of other arguments that are mostly for testing purposes; see the code below for details.
-# Note that this script assumes Python 3.6 or higher. Before running this script, you will need to install geopandas and numpy.
+#
+# The batcher can also be used as a library, e.g. from a scheduler or a notebook. Importing it has no side effects (it
+# doesn't read the command line or any files), and it only imports geopandas and the other heavy libraries when it
+# first processes a quarter, so importing it and --help are quick. For example:
+#   import ookla_data_quadkey_batcher as batcher
+#   batcher.configure(["--cache-dir", "ookla-cache"])  # optional: any command line arguments; the defaults otherwise
+#   location_stats = batcher.process_quarter("fixed", 2021, 1, {"guam": ["1323"]})
+#   location_stats["guam"].stats()
+# main(argv) runs a whole batch, like the command line does.
+# Note that this script assumes Python 3.9 or higher. Before running this script, you will need to install geopandas and numpy.
 
 import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
 import json
+import glob
 import os
+import sys
+import threading
+import traceback
+import urllib.parse
+import urllib.request
 from datetime import datetime
 
-import geopandas as gp
-import numpy as np
+# These only need the standard library. geopandas, numpy and the modules that use them are imported by the functions
+# that need them.
+from instrumentation import Tracer, profiled, trace_formats
+from output_stage import OutputStage
+from prefetch import Prefetcher
+from stats_store import StatsStore, stats_db_filename
+from tile_cache import TileCache
 
 
 # Create a quick numpy encoder so we can serialize our statistics to a file
@@ -45,6 +119,9 @@ import numpy as np
 # Todo move to a utils file
 class NpEncoder(json.JSONEncoder):
     def default(self, obj):
+        # Only called for objects json can't serialize itself, and those come from numpy, so it's already loaded
+        import numpy as np
+
         if isinstance(obj, np.integer):
             return int(obj)
         if isinstance(obj, np.floating):
@@ -57,88 +134,369 @@ class NpEncoder(json.JSONEncoder):
 # Directory where the output files will be saved
 directory = "geojson-datasets"
 
-# Set the years and quarters to process. The default is to process all available data using the constant start year and quarter, and the current date.
-# Create the parser
-parser = argparse.ArgumentParser(description="Process Ookla data.")
-
 # These are constants, the start year and quarter of available Ookla data in the repository.
 ookla_data_start_year = 2019
 ookla_data_start_quarter = 1
-
-# Get the current year and quarter
-current_year = datetime.now().year
-current_month = datetime.now().month
-current_quarter = (current_month - 1) // 3 + 1
-
-# Calculate the most recent year and quarter with available data
-most_recent_year = current_year if current_quarter > 1 else current_year - 1
-most_recent_quarter = current_quarter - 1 if current_quarter > 1 else 4
-
-# Add the arguments
-parser.add_argument(
-    "--start_year",
-    type=int,
-    default=ookla_data_start_year,
-    help="The start year to process.",
-)
-parser.add_argument(
-    "--start_quarter",
-    type=int,
-    default=ookla_data_start_quarter,
-    help="The start quarter to process.",
-)
-parser.add_argument(
-    "--end_year", type=int, default=most_recent_year, help="The end year to process."
-)
-parser.add_argument(
-    "--end_quarter",
-    type=int,
-    default=most_recent_quarter,
-    help="The end quarter to process.",
-)
-parser.add_argument(
-    "--mobile",
-    action="store_true",
-    help="Process mobile data instead of fixed internet service.",
-)
-parser.add_argument(
-    "--preserve-stats",
-    type=bool,
-    default=True,
-    help="Preserve existing stats.json file.",
-)
-parser.add_argument(
-    "--testing", action="store_true", help="Use test data instead of Ookla data."
+ookla_base_url = (
+    "https://ookla-open-data.s3-us-west-2.amazonaws.com/shapefiles/performance"
 )
 
-# Parse the arguments
-args = parser.parse_args()
+# The columns the stats need, which is all that's read with --geometry-from-quadkeys when no tiles are written out
+stats_tile_columns = [
+    "quadkey",
+    "avg_d_kbps",
+    "avg_u_kbps",
+    "avg_lat_ms",
+    "tests",
+    "devices",
+]
+
+# Bump this whenever the way stats are computed changes, so --incremental recomputes them
+stats_version = 2
+
+# Default checkpoint file of a batch, for --resume
+checkpoint_filename = "batch-checkpoint.json"
+
+
+def latest_quarter() -> tuple:
+    # The most recent year and quarter with available data: the quarter before the current one
+    current_year = datetime.now().year
+    current_month = datetime.now().month
+    current_quarter = (current_month - 1) // 3 + 1
+    most_recent_year = current_year if current_quarter > 1 else current_year - 1
+    most_recent_quarter = current_quarter - 1 if current_quarter > 1 else 4
+    return most_recent_year, most_recent_quarter
+
+
+def build_parser() -> argparse.ArgumentParser:
+    # Set the years and quarters to process. The default is to process all available data using the constant start year and quarter, and the current date.
+    most_recent_year, most_recent_quarter = latest_quarter()
+    # Create the parser
+    parser = argparse.ArgumentParser(description="Process Ookla data.")
+
+    # Add the arguments
+    parser.add_argument(
+        "--start_year",
+        type=int,
+        default=ookla_data_start_year,
+        help="The start year to process.",
+    )
+    parser.add_argument(
+        "--start_quarter",
+        type=int,
+        default=ookla_data_start_quarter,
+        help="The start quarter to process.",
+    )
+    parser.add_argument(
+        "--end_year",
+        type=int,
+        default=most_recent_year,
+        help="The end year to process.",
+    )
+    parser.add_argument(
+        "--end_quarter",
+        type=int,
+        default=most_recent_quarter,
+        help="The end quarter to process.",
+    )
+    parser.add_argument(
+        "--mobile",
+        action="store_true",
+        help="Process mobile data instead of fixed internet service.",
+    )
+    parser.add_argument(
+        "--service",
+        choices=["fixed", "mobile", "both"],
+        default=None,
+        help="The service type(s) to process; --service mobile is the same as --mobile.",
+    )
+    parser.add_argument(
+        "--preserve-stats",
+        type=bool,
+        default=True,
+        help="Preserve existing stats.json file.",
+    )
+    parser.add_argument(
+        "--stats-db",
+        default=stats_db_filename,
+        help="The SQLite file the stats are kept in (see stats_store.py).",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=checkpoint_filename,
+        help="The file that records which quarters of the batch are committed, for --resume.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the interrupted batch in the --checkpoint file, with its arguments, skipping its committed quarters.",
+    )
+    parser.add_argument(
+        "--testing", action="store_true", help="Use test data instead of Ookla data."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Cache downloaded Ookla files in this directory and reuse them on later runs.",
+    )
+    parser.add_argument(
+        "--cache-max-gb",
+        type=float,
+        default=None,
+        help="Maximum size of the download cache; least recently used files are evicted.",
+    )
+    parser.add_argument(
+        "--cache-verify",
+        action="store_true",
+        help="Verify the checksum of cached files before using them.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process quarters and locations that are missing from the stats store, or out of date.",
+    )
+    parser.add_argument(
+        "--tile-store",
+        default=None,
+        help="Also save the tiles for each location to a GeoParquet store in this directory.",
+    )
+    parser.add_argument(
+        "--skip-geojson",
+        action="store_true",
+        help="Don't write geojson files (they can be exported from the --tile-store later).",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read each quarter in batches of --batch-size tiles, instead of all at once.",
+    )
+    parser.add_argument(
+        "--geometry-from-quadkeys",
+        action="store_true",
+        help="Read only the tiles' attributes, and build the polygons of the tiles that are written out from their quadkeys.",
+    )
+    parser.add_argument(
+        "--location-hierarchy",
+        action="store_true",
+        help="Derive the stats and files of locations that contain others (e.g. hawaii-state) from the locations inside them.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100000,
+        help="Number of tiles per batch with --stream.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Process this many quarters at once, each in its own process.",
+    )
+    parser.add_argument(
+        "--worker-memory-gb",
+        type=float,
+        default=8,
+        help="Expected peak memory of one worker; limits --workers to what fits in available memory.",
+    )
+    parser.add_argument(
+        "--log-dir",
+        default="batch-logs",
+        help="Directory for the per-quarter logs written by --workers.",
+    )
+    parser.add_argument(
+        "--base-url",
+        default=ookla_base_url,
+        help="Base URL of the Ookla performance files, e.g. a file:// or local http mirror for testing.",
+    )
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help="Write the time, CPU time, memory and tiles of every processing stage to this file.",
+    )
+    parser.add_argument(
+        "--trace-format",
+        choices=trace_formats,
+        default="jsonl",
+        help="Format of the --trace file: JSON lines, or the Chrome trace event format.",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="Run each quarter under cProfile, and save the profiles in this directory.",
+    )
+    parser.add_argument(
+        "--output-threads",
+        type=int,
+        default=4,
+        help="Write the output files with this many threads, while the next quarter is processed (0 to write them inline).",
+    )
+    parser.add_argument(
+        "--geojson-precision",
+        type=int,
+        default=None,
+        help="Round geojson coordinates to this many decimal places (default: not rounded; the shortest decimals that read back as the same coordinates).",
+    )
+    parser.add_argument(
+        "--pyramid-levels",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Also write each location's tiles rolled up to these lower zoom levels (e.g. 14 12 10), one geojson file per level.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="Download up to this many of the next quarters into the --cache-dir while the current one is processed.",
+    )
+    return parser
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    # Parse command line arguments; sys.argv unless argv is given
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.prefetch and not args.cache_dir:
+        parser.error("--prefetch needs a --cache-dir to download into")
+    if args.pyramid_levels and not all(0 < level < 16 for level in args.pyramid_levels):
+        parser.error("--pyramid-levels must be below the Ookla tiles' zoom level, 16")
+    return args
+
+
+def stats_filename(service_type: str) -> str:
+    # stats filename is stats_fixed.json or stats_mobile.json
+    return f"stats_{service_type}.json"
+
+
+def pyramid_filenames(
+    service_type: str, location: str, year: int, quarter: int
+) -> dict:
+    # The geojson file of each of the --pyramid-levels, e.g. guam_ookla_2021Q1_z12.geojson
+    return {
+        level: f"{directory}/{service_type}/{location}_ookla_{year}Q{quarter}_z{level}.geojson"
+        for level in args.pyramid_levels or []
+    }
+
+
+def manifest_filename(service_type: str) -> str:
+    # Earlier versions kept the manifest in its own file; it's only read to import it into the stats store
+    return f"stats_{service_type}.manifest.json"
+
+
+def aggregates_filename(service_type: str) -> str:
+    # Earlier versions kept the aggregates in their own file; it's only read to import it into the stats store
+    return f"stats_{service_type}.aggregates.json"
+
+
+# The stats of every service type, keyed by service type
+combined_stats_filename = "stats_combined.json"
+
 
-# Some args are constants
-# start_year is args.start_year or ookla_data_start_year
-start_year = args.start_year if args.start_year else ookla_data_start_year
-# start_quarter is args.start_quarter or ookla_data_start_quarter
-start_quarter = args.start_quarter if args.start_quarter else ookla_data_start_quarter
-# end_year is args.end_year or most_recent_year
-end_year = args.end_year if args.end_year else most_recent_year
-# end_quarter is args.end_quarter or most_recent_quarter
-end_quarter = args.end_quarter if args.end_quarter else most_recent_quarter
+def load_json(filename: str) -> dict:
+    # Load a json file if it exists, otherwise start from an empty dictionary
+    if os.path.exists(filename):
+        with open(filename, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def configure(argv: list = None) -> argparse.Namespace:
+    # Set up the batcher from command line arguments (sys.argv unless argv is given; [] for the defaults): the quarters
+    # and service types to process, the download cache, the tracer and the output stage. The module is configured with
+    # the defaults when it is imported, so configure only needs to be called to change them.
+    global args, start_year, start_quarter, end_year, end_quarter, service_types, testing
+    global tile_cache, tracer, output_stage
+    args = parse_args(argv)
+    most_recent_year, most_recent_quarter = latest_quarter()
+
+    # Some args are constants
+    # start_year is args.start_year or ookla_data_start_year
+    start_year = args.start_year if args.start_year else ookla_data_start_year
+    # start_quarter is args.start_quarter or ookla_data_start_quarter
+    start_quarter = (
+        args.start_quarter if args.start_quarter else ookla_data_start_quarter
+    )
+    # end_year is args.end_year or most_recent_year
+    end_year = args.end_year if args.end_year else most_recent_year
+    # end_quarter is args.end_quarter or most_recent_quarter
+    end_quarter = args.end_quarter if args.end_quarter else most_recent_quarter
+
+    # The service types to process: fixed internet, mobile, or both
+    if args.service == "both":
+        service_types = ["fixed", "mobile"]
+    else:
+        service_types = [args.service or ("mobile" if args.mobile else "fixed")]
+
+    # Set the testing flag
+    testing = args.testing
+
+    # Set up the download cache, if we have one
+    if args.cache_dir:
+        cache_max_bytes = (
+            int(args.cache_max_gb * 1024**3)
+            if args.cache_max_gb is not None
+            else None
+        )
+        tile_cache = TileCache(args.cache_dir, cache_max_bytes, args.cache_verify)
+    else:
+        tile_cache = None
+
+    # Spans for every stage of the work go to the --trace file, if there is one
+    tracer = Tracer(args.trace, args.trace_format)
+
+    # The output files are written in the background by the output stage
+    output_stage = OutputStage(args.output_threads)
+    return args
+
+
+def load_stats():
+    # Open the stats store. A service type that isn't in the store yet gets the stats, manifest and aggregates from the
+    # json files of earlier versions, if there are any. Without --preserve-stats, the service types we process start
+    # with no stats.
+    global stats_store
+    stats_store = StatsStore(args.stats_db)
+    stored_service_types = stats_store.services()
+    for service_type in ["fixed", "mobile"]:
+        # (A resumed batch already started from no stats, and keeps the quarters it committed)
+        if (
+            service_type in service_types
+            and not args.preserve_stats
+            and not args.resume
+        ):
+            stats_store.clear(service_type)
+        elif service_type not in stored_service_types and os.path.exists(
+            stats_filename(service_type)
+        ):
+            stats_store.import_json(
+                service_type,
+                load_json(stats_filename(service_type)),
+                load_json(manifest_filename(service_type)),
+                load_json(aggregates_filename(service_type)),
+            )
+            print(f"Imported {service_type} stats into {args.stats_db}.")
+    for service_type in service_types:
+        service_stats = stats_store.stats_dict(service_type)
+        if service_stats:
+            print(f"Loaded {service_type} stats for {len(service_stats)} quarters.")
 
-fixed_or_mobile = "mobile" if args.mobile else "fixed"
-# stats filename is stats_fixed.json or stats_mobile.json
-stats_filename = f"stats_{fixed_or_mobile}.json"
 
-# Set the testing flag
-testing = args.testing
+# The stats store; opened by load_stats
+stats_store = None
 
-# If preserve-stats is True and {stats_filename} exists, load its contents into stats
-if args.preserve_stats and os.path.exists(stats_filename):
-    with open(stats_filename, "r") as f:
-        stats = json.load(f)
-    print(f"Loaded stats for {len(stats)} quarters.")
-# Otherwise, initialize stats as an empty dictionary
-else:
-    stats = {}
+# The checkpoint of the batch main() is running: its arguments, its quarters, and the ones that are committed
+checkpoint = None
+
+# Downloads the next quarters in the background with --prefetch; set up by main() once it knows the quarters
+prefetcher = None
+
+# The LocationIndex and read mask for each set of locations (see location_filter)
+location_filters = {}
+
+# The LocationHierarchy of each set of locations, with --location-hierarchy (see get_location_hierarchy)
+location_hierarchies = {}
+
+# Start with the default configuration
+configure([])
 
 
 def make_quarters_list() -> list:
@@ -170,91 +528,934 @@ def quarter_start(year: int, q: int) -> datetime:
     return datetime(year, month[q - 1], 1)
 
 
-def get_tile_url(service_type: str, year: int, q: int) -> str:
+def get_tile_url(
+    service_type: str, year: int, q: int, base_url: str = ookla_base_url
+) -> str:
     dt = quarter_start(year, q)
-    base_url = (
-        "https://ookla-open-data.s3-us-west-2.amazonaws.com/shapefiles/performance"
-    )
     url = f"{base_url}/type%3D{service_type}/year%3D{dt:%Y}/quarter%3D{q}/{dt:%Y-%m-%d}_performance_{service_type}_tiles.zip"
     return url
 
 
-def main():
+def get_tile_input(service_type: str, year: int, q: int) -> str:
+    # The file we read a quarter's tiles from: the test data if we are testing, otherwise the Ookla url
+    if testing:
+        return "ookla-test-data.zip"
+    return get_tile_url(service_type, year, q, args.base_url)
+
+
+def location_filter(location_quadkeys: dict) -> tuple:
+    # The LocationIndex and read mask for a set of locations. They are built once for each set of locations, and shared
+    # by every quarter and service type, and by the worker processes, which are forked after main() builds them.
+    from quadkey_index import LocationIndex, locations_mask
+
+    key = json.dumps(location_quadkeys, sort_keys=True)
+    if key not in location_filters:
+        # The quadkey ranges of every location, for assigning tiles to locations (see quadkey_index.py)
+        location_index = LocationIndex(location_quadkeys)
+        # Every location is a set of quadkey prefixes, and every prefix is a lat/lon box.
+        # We pass the union of those boxes to read_file, so only matching tiles are loaded from the (global) file.
+        read_mask = locations_mask(location_quadkeys)
+        location_filters[key] = (location_index, read_mask)
+    return location_filters[key]
+
+
+def get_location_hierarchy(location_quadkeys: dict):
+    # With --location-hierarchy, the LocationHierarchy of a set of locations (see location_hierarchy.py), built once for
+    # each set of locations, like location_filter. None without it, or when none of the locations are inside another.
+    if not args.location_hierarchy:
+        return None
+    from location_hierarchy import LocationHierarchy
+
+    key = json.dumps(location_quadkeys, sort_keys=True)
+    if key not in location_hierarchies:
+        hierarchy = LocationHierarchy(location_quadkeys)
+        location_hierarchies[key] = hierarchy if hierarchy.children else None
+    return location_hierarchies[key]
+
+
+def writes_tiles() -> bool:
+    # Whether the tiles themselves (with their polygons) are written anywhere
+    return bool(args.tile_store) or not args.skip_geojson
+
+
+def output_tiles(tiles):
+    # The tiles to write out. With --geometry-from-quadkeys they were read without their polygons, so build them from
+    # the quadkeys, if any output needs them.
+    import geopandas as gp
+
+    from quadkey_index import quadkey_polygons
+
+    if isinstance(tiles, gp.GeoDataFrame) or not writes_tiles():
+        return tiles
+    return gp.GeoDataFrame(
+        tiles, geometry=quadkey_polygons(tiles["quadkey"]), crs="EPSG:4326"
+    )
+
+
+def located_rows(location_rows: dict):
+    # The rows of the tiles in at least one location, in order, each of them once, even if it's in several overlapping
+    # locations (e.g. oahu and hawaii-state). Empty if there are no locations, or no tiles in them.
+    import numpy as np
+
+    rows = [rows for rows in location_rows.values() if len(rows)]
+    return np.unique(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+
+
+def read_location_attributes(tile_source: str, location_index):
+    # With --geometry-from-quadkeys, read the tiles without their polygons. There's no spatial filter without them, so
+    # the whole file is read, in batches of --batch-size, and only the tiles in our locations are kept from each batch.
+    import pandas as pd
+
+    from tile_stream import iter_tile_batches
+
+    location_tiles = []
+    for tiles in iter_tile_batches(
+        tile_source,
+        args.batch_size,
+        read_geometry=False,
+        columns=None if writes_tiles() else stats_tile_columns,
+    ):
+        location_rows = location_index.locate(tiles["quadkey"])
+        location_tiles.append(tiles.iloc[located_rows(location_rows)])
+    if not location_tiles:
+        # The file has no tiles at all
+        return pd.DataFrame(columns=stats_tile_columns)
+    return pd.concat(location_tiles, ignore_index=True)
+
+
+def manifest_entry(service_type: str, year: int, q: int, quadkeys: list) -> dict:
+    # What the stats for one quarter and location depend on. If any of this changes, the stats are out of date.
+    quadkeys_hash = hashlib.sha1(json.dumps(sorted(quadkeys)).encode()).hexdigest()
+    return {
+        "input": get_tile_input(service_type, year, q),
+        "quadkeys": quadkeys_hash,
+        "version": stats_version,
+    }
+
+
+def locations_to_process(
+    service_type: str, year: int, q: int, location_quadkeys: dict
+) -> dict:
+    # The locations of a quarter that are missing from stats, or whose manifest entry is out of date
+    quarter_year = str(year) + "Q" + str(q)
+    quarter_manifest = stats_store.manifest(service_type, quarter_year)
+    return {
+        location: quadkeys
+        for location, quadkeys in location_quadkeys.items()
+        if quarter_manifest.get(location)
+        != manifest_entry(service_type, year, q, quadkeys)
+    }
+
+
+def print_location_stats(location: str, year: int, quarter: int, location_stats: dict):
+    print(
+        f"{location} {year}Q{quarter} Stats...\n Download (mean Mbps) {location_stats['download']}\n Upload (mean Mbps) {location_stats['upload']}\n Latency (mean ms) {location_stats['latency']}\n Tests {location_stats['tests']} Devices {location_stats['devices']}\n"
+    )
+
+
+def open_location_writers(
+    service_type: str, location: str, year: int, quarter: int
+) -> list:
+    # The writers of all of a location's output files for a quarter, which take the tiles a batch at a time
+    from geojson_writer import GeoJSONStreamWriter
+    from tile_pyramid import TilePyramidWriter
+    from tile_store import TileStoreWriter
+
+    quarter_year = str(year) + "Q" + str(quarter)
+    writers = []
+    if args.tile_store:
+        writers.append(
+            TileStoreWriter(args.tile_store, service_type, quarter_year, location)
+        )
+    if not args.skip_geojson:
+        geojson_filename = (
+            f"{directory}/{service_type}/{location}_ookla_{year}Q{quarter}.geojson"
+        )
+        writers.append(GeoJSONStreamWriter(geojson_filename, args.geojson_precision))
+    if args.pyramid_levels:
+        writers.append(
+            TilePyramidWriter(
+                pyramid_filenames(service_type, location, year, quarter),
+                args.geojson_precision,
+            )
+        )
+    return writers
+
+
+def write_shared(writers: list, tiles):
+    # Write tiles to the output writers of one or more locations (each from open_location_writers). Tiles that are in
+    # several locations, with --location-hierarchy, are only serialized and rolled up into pyramid sums once.
+    from geojson_writer import GeoJSONStreamWriter, feature_lines
+    from tile_pyramid import TilePyramidWriter
+
+    lines = level_sums = None
+    for location_writers in writers:
+        for writer in location_writers:
+            if isinstance(writer, GeoJSONStreamWriter):
+                if lines is None:
+                    lines = feature_lines(tiles, writer.precision)
+                writer.write_lines(lines)
+            elif isinstance(writer, TilePyramidWriter):
+                if level_sums is None:
+                    level_sums = writer.level_sums(tiles)
+                writer.add_sums(level_sums)
+            else:
+                writer.write(tiles)
+
+
+def process_tiles_streaming(
+    service_type: str,
+    tile_source: str,
+    year: int,
+    quarter: int,
+    location_index,
+    read_mask,
+    hierarchy=None,
+) -> tuple:
+    # The --stream version of process_quarter: read the tiles in batches of --batch-size, and hand each batch's tiles
+    # to per-location running stats and output writers, so the whole quarter is never in memory at once.
+    # Returns the TileStats by location, and the number of tiles in them (see process_quarter_tiles).
+    # With a LocationHierarchy, location_index locates its pieces, and each piece's tiles go to the writers of every
+    # location it's part of.
+    from tile_stats import TileStats
+    from tile_stream import iter_tile_batches
+
+    geometry_from_quadkeys = args.geometry_from_quadkeys
+
+    quarter_year = str(year) + "Q" + str(quarter)
+    pieces = location_index.location_quadkeys
+    if hierarchy is None:
+        locations = pieces
+        piece_locations = {location: [location] for location in pieces}
+    else:
+        locations = hierarchy.location_quadkeys
+        piece_locations = hierarchy.piece_locations()
+    # Running stats, by piece
+    piece_stats = {piece: TileStats() for piece in pieces}
+    # Output writers, by location
+    writers = {
+        location: open_location_writers(service_type, location, year, quarter)
+        for location in locations
+    }
+
+    span_attributes = {"service": service_type, "quarter": quarter_year}
+    tile_count = 0
+    located_count = 0
+    try:
+        if geometry_from_quadkeys:
+            batches = iter_tile_batches(
+                tile_source,
+                args.batch_size,
+                read_geometry=False,
+                columns=None if writes_tiles() else stats_tile_columns,
+            )
+        else:
+            batches = iter_tile_batches(tile_source, args.batch_size, read_mask)
+        for batch in itertools.count():
+            # Reading the next batch is the parse stage (and the download, if it's read straight from the url)
+            with tracer.span("parse", batch=batch, **span_attributes) as span:
+                tiles = next(batches, None)
+                span.rows = 0 if tiles is None else len(tiles)
+            if tiles is None:
+                break
+            tile_count += len(tiles)
+            with tracer.span("filter", batch=batch, **span_attributes) as span:
+                location_rows = location_index.locate(tiles["quadkey"])
+                span.rows = len(located_rows(location_rows))
+            located_count += span.rows
+            for piece, rows in location_rows.items():
+                piece_tiles = tiles.iloc[rows]
+                with tracer.span(
+                    "aggregate", batch=batch, location=piece, **span_attributes
+                ) as span:
+                    piece_stats[piece].update(piece_tiles)
+                    span.rows = len(piece_tiles)
+                with tracer.span(
+                    "write", batch=batch, location=piece, **span_attributes
+                ) as span:
+                    piece_writers = [
+                        writers[location] for location in piece_locations[piece]
+                    ]
+                    if any(piece_writers):
+                        piece_tiles = output_tiles(piece_tiles)
+                    write_shared(piece_writers, piece_tiles)
+                    span.rows = len(piece_tiles)
+    except BaseException:
+        for location_writers in writers.values():
+            for writer in location_writers:
+                writer.abort()
+        raise
+    for location_writers in writers.values():
+        for writer in location_writers:
+            writer.close()
+    print("Streamed ", tile_count, "tiles near our locations.")
+
+    location_stats = (
+        piece_stats if hierarchy is None else hierarchy.merge_stats(piece_stats)
+    )
+    for location in locations:
+        print_location_stats(location, year, quarter, location_stats[location].stats())
+    return location_stats, located_count
+
+
+def process_quarter(
+    service_type: str,
+    year: int,
+    quarter: int,
+    location_quadkeys: dict,
+    wait_for_files: bool = True,
+) -> dict:
+    # Process one quarter: read the quarter's tiles, then get the stats and write the geojson file for every location.
+    # Returns the TileStats for the quarter, by location.
+    # The whole quarter is one span in the trace, and is profiled with --profile.
+    # The files are written by the output stage. With wait_for_files=False, this returns without waiting for them,
+    # and the caller has to wait for them with output_stage.finish or on_finished (see commit_when_written).
+    quarter_year = str(year) + "Q" + str(quarter)
+    profile_filename = (
+        f"{args.profile}/{service_type}_{quarter_year}.prof" if args.profile else None
+    )
+    with profiled(profile_filename), tracer.span(
+        "quarter", service=service_type, quarter=quarter_year
+    ) as span:
+        try:
+            location_stats, span.rows = process_quarter_tiles(
+                service_type, year, quarter, location_quadkeys
+            )
+        finally:
+            # We're done reading the quarter's file, so the cache can evict it again
+            if tile_cache is not None:
+                tile_cache.release(service_type, year, quarter)
+    if wait_for_files:
+        output_stage.finish(f"{service_type} {quarter_year}")
+    return location_stats
+
+
+def process_quarter_tiles(
+    service_type: str, year: int, quarter: int, location_quadkeys: dict
+) -> tuple:
+    # Returns the TileStats by location, and the number of tiles in them, counting each tile once (the quarter span's
+    # rows)
+    import geopandas as gp
+
+    from tile_stats import TileStats
+
+    # Save start time to calculate processing time
+    start_time = datetime.now()
+    quarter_year = str(year) + "Q" + str(quarter)
+    span_attributes = {"service": service_type, "quarter": quarter_year}
+    print(
+        "Processing",
+        service_type,
+        "quarter",
+        quarter_year,
+        "for",
+        len(location_quadkeys),
+        "locations",
+    )
+    # The location index and read mask (see location_filter). With --location-hierarchy, they're for the locations'
+    # pieces (see get_location_hierarchy)
+    hierarchy = get_location_hierarchy(location_quadkeys)
+    location_index, read_mask = location_filter(
+        location_quadkeys if hierarchy is None else hierarchy.pieces
+    )
+    # Get the file
+    tile_input = get_tile_input(service_type, year, quarter)  # all set by args
+    # Now we need to read the geodata file from the url. However, if we are just testing, we read from a local file.
+    # If we have a cache, the file is read from there (and downloaded into it first if needed). Without a cache,
+    # GDAL reads the file straight from the url, so the download is part of the parse stage.
+    if testing:
+        tile_source = tile_input
+    elif tile_cache is not None:
+        # With --prefetch, this is just the time spent waiting for the download to finish
+        with tracer.span("download", **span_attributes):
+            if prefetcher is not None:
+                tile_source = prefetcher.fetch(tile_input, service_type, year, quarter)
+            else:
+                tile_source = tile_cache.fetch(tile_input, service_type, year, quarter)
+    elif tile_input.startswith("file://"):
+        # GDAL doesn't read file:// urls (e.g. from --base-url), so use the path
+        tile_source = urllib.request.url2pathname(
+            urllib.parse.urlparse(tile_input).path
+        )
+    else:
+        print("Downloading ", tile_input)
+        tile_source = tile_input
+    if args.stream:
+        location_stats, located_count = process_tiles_streaming(
+            service_type,
+            tile_source,
+            year,
+            quarter,
+            location_index,
+            read_mask,
+            hierarchy,
+        )
+        # Calculate processing time
+        processing_time = datetime.now() - start_time
+        print("Processing time for quarter", quarter_year, "was", processing_time)
+        return location_stats, located_count
+
+    with tracer.span("parse", **span_attributes) as span:
+        if args.geometry_from_quadkeys:
+            all_tiles = read_location_attributes(tile_source, location_index)
+        else:
+            all_tiles = gp.read_file(tile_source, mask=read_mask)
+        span.rows = len(all_tiles)
+    print("Downloaded ", len(all_tiles), "tiles near our locations.")
+
+    # Assign the tiles to locations in one pass over the (integer-encoded) quadkeys,
+    # rather than scanning all of the tiles again for every location.
+    with tracer.span("filter", **span_attributes) as span:
+        location_rows = location_index.locate(all_tiles["quadkey"])
+        span.rows = len(located_rows(location_rows))
+    located_count = span.rows
+
+    # Process into tiles
+    location_stats = {}
+    #   For each territory (or with --location-hierarchy, each piece of one)
+    for location in location_index.location_quadkeys:
+        print("Processing location", location)
+        #     Filter into smaller tiles: the tiles that start with any of the territory's quadkeys.
+        location_tiles = all_tiles.iloc[location_rows[location]]
+        #     Get statistics
+        with tracer.span("aggregate", location=location, **span_attributes) as span:
+            location_stats[location] = TileStats().update(location_tiles)
+            span.rows = len(location_tiles)
+        if hierarchy is not None:
+            continue
+        print_location_stats(location, year, quarter, location_stats[location].stats())
+        #     Write the location's files in the background
+        output_stage.submit(
+            f"{service_type} {quarter_year}",
+            write_location_tiles,
+            service_type,
+            location_tiles,
+            year,
+            quarter,
+            location,
+        )
+        # End for each location
+    if hierarchy is not None:
+        #   The stats of the locations that contain others are merged from their pieces'
+        location_stats = hierarchy.merge_stats(location_stats)
+        for location, tile_stats in location_stats.items():
+            print_location_stats(location, year, quarter, tile_stats.stats())
+        #   Write each family of locations' files together, in the background
+        for root in hierarchy.roots():
+            piece_locations = hierarchy.piece_locations(hierarchy.family(root))
+            output_stage.submit(
+                f"{service_type} {quarter_year}",
+                write_location_family,
+                service_type,
+                {
+                    piece: all_tiles.iloc[location_rows[piece]]
+                    for piece in piece_locations
+                },
+                piece_locations,
+                year,
+                quarter,
+                root,
+            )
+    # Calculate processing time
+    end_time = datetime.now()
+    processing_time = end_time - start_time
+    print("Processing time for quarter", quarter_year, "was", processing_time)
+    return location_stats, located_count
+
+
+def write_location_tiles(
+    service_type: str, location_tiles, year: int, quarter: int, location: str
+):
+    # Write one location's tiles for a quarter to its output files. Runs in the output stage.
+    from geojson_writer import write_geojson
+    from tile_pyramid import write_pyramid
+    from tile_store import write_tiles
+
+    quarter_year = str(year) + "Q" + str(quarter)
+    with tracer.span(
+        "write", service=service_type, quarter=quarter_year, location=location
+    ) as span:
+        location_tiles = output_tiles(location_tiles)
+        #     Save location_tiles to the tile store, if we have one
+        if args.tile_store:
+            write_tiles(
+                location_tiles, args.tile_store, service_type, quarter_year, location
+            )
+        #     Write location_tiles to new file in geojson-datasets.
+        #     Filename should be {location}_ookla_{year}Q{quarter}.geojson
+        if not args.skip_geojson:
+            geojson_filename = (
+                f"{directory}/{service_type}/{location}_ookla_{year}Q{quarter}.geojson"
+            )
+            write_geojson(location_tiles, geojson_filename, args.geojson_precision)
+        #     Write the lower zoom levels, if we want them
+        if args.pyramid_levels:
+            write_pyramid(
+                location_tiles,
+                pyramid_filenames(service_type, location, year, quarter),
+                args.geojson_precision,
+            )
+        span.rows = len(location_tiles)
+
+
+def write_location_family(
+    service_type: str,
+    piece_tiles: dict,
+    piece_locations: dict,
+    year: int,
+    quarter: int,
+    location: str,
+):
+    # With --location-hierarchy: write the output files of a location and all the locations inside it, from the tiles
+    # of their pieces (piece -> tiles, and piece -> the locations it's part of). Each piece's tiles are written to the
+    # files of all its locations at once. Runs in the output stage.
+    quarter_year = str(year) + "Q" + str(quarter)
+    family = list(
+        dict.fromkeys(
+            family_location
+            for locations in piece_locations.values()
+            for family_location in locations
+        )
+    )
+    writers = {
+        family_location: open_location_writers(
+            service_type, family_location, year, quarter
+        )
+        for family_location in family
+    }
+    all_writers = [
+        writer for family_writers in writers.values() for writer in family_writers
+    ]
+    with tracer.span(
+        "write", service=service_type, quarter=quarter_year, location=location
+    ) as span:
+        span.rows = 0
+        try:
+            for piece, tiles in piece_tiles.items():
+                write_shared(
+                    [
+                        writers[family_location]
+                        for family_location in piece_locations[piece]
+                    ],
+                    output_tiles(tiles),
+                )
+                span.rows += len(tiles)
+        except BaseException:
+            for writer in all_writers:
+                writer.abort()
+            raise
+        for writer in all_writers:
+            writer.close()
+
+
+def process_quarter_logged(
+    service_type: str, year: int, quarter: int, location_quadkeys: dict
+) -> dict:
+    # Run process_quarter in a worker process, with all of its output going to the quarter's own log file.
+    log_filename = f"{args.log_dir}/{service_type}_{year}Q{quarter}.log"
+    with open(log_filename, "w") as log, contextlib.redirect_stdout(
+        log
+    ), contextlib.redirect_stderr(log):
+        try:
+            return process_quarter(service_type, year, quarter, location_quadkeys)
+        except BaseException:
+            traceback.print_exc()
+            raise
+
+
+def available_memory_bytes():
+    # Memory available for new processes, or None if we can't tell on this platform
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def worker_count(requested: int, jobs: list) -> int:
+    # Never run more workers than quarters, or than fit in memory at --worker-memory-gb each
+    workers = max(1, min(requested, len(jobs)))
+    if workers == 1:
+        return workers
+    available = available_memory_bytes()
+    if available is not None:
+        fits = max(1, int(available // (args.worker_memory_gb * 1024**3)))
+        if fits < workers:
+            print(
+                f"Only enough memory for {fits} of {workers} workers at {args.worker_memory_gb} GB each."
+            )
+            workers = fits
+    return workers
+
+
+def process_quarters_in_pool(jobs: list, workers: int, argv: list) -> tuple:
+    # Process quarters in a pool of worker processes. Each quarter is independent, so they can run in any order.
+    # jobs is a list of (service_type, year, quarter, location_quadkeys).
+    # Each quarter is merged into the stats store as soon as it's finished, so an interrupted batch keeps the finished
+    # quarters. Returns a list of the quarters that failed.
+    # Every worker is configured with the same arguments (argv) as the batch. That also gives each worker its own
+    # output stage, since thread pools don't survive being forked.
+    os.makedirs(args.log_dir, exist_ok=True)
+    print(
+        "Processing quarters with",
+        workers,
+        "workers, logging to",
+        args.log_dir,
+    )
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=configure, initargs=(argv,)
+    ) as executor:
+        futures = {executor.submit(process_quarter_logged, *job): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            service_type, year, quarter, quarter_locations = futures[future]
+            quarter_year = str(year) + "Q" + str(quarter)
+            try:
+                location_stats = future.result()
+                print("Finished", service_type, "quarter", quarter_year)
+            except Exception as e:
+                # One failed quarter shouldn't lose the others; see the quarter's log for the details
+                print(service_type, "quarter", quarter_year, "failed:", repr(e))
+                failed.append(f"{service_type} {quarter_year}")
+                continue
+            merge_quarter(
+                service_type, year, quarter, quarter_locations, location_stats
+            )
+    return sorted(failed)
+
+
+def merge_quarter(
+    service_type: str,
+    year: int,
+    quarter: int,
+    location_quadkeys: dict,
+    location_stats: dict,
+):
+    # Save one processed quarter (TileStats by location) to the stats store, with its aggregates and what it was
+    # computed from (the manifest). The quarter is saved in one transaction, so it's in the store in full or not at all.
+    quarter_year = str(year) + "Q" + str(quarter)
+    stats_store.upsert_quarter(
+        service_type,
+        quarter_year,
+        [
+            (
+                location,
+                tile_stats.stats(),
+                manifest_entry(
+                    service_type, year, quarter, location_quadkeys[location]
+                ),
+                tile_stats.to_dict(),
+            )
+            for location, tile_stats in location_stats.items()
+        ],
+    )
+    if checkpoint is not None:
+        checkpoint["committed"].append(f"{service_type} {quarter_year}")
+        save_checkpoint()
+
+
+def read_checkpoint(filename: str) -> dict:
+    # The checkpoint of an interrupted batch, or None if there isn't one
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def save_checkpoint():
+    # Write the checkpoint atomically, so it's always either the old one or the new one
+    tmp_filename = args.checkpoint + ".tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(checkpoint, f, indent=1)
+    os.replace(tmp_filename, args.checkpoint)
+
+
+def remove_partial_files():
+    # Remove the .tmp files of an interrupted batch: the output files it was writing, which are only renamed into place
+    # when they are complete (see geojson_writer.py and tile_store.py), and the stats exports
+    patterns = [f"{directory}/{service_type}/*.tmp" for service_type in service_types]
+    patterns += [
+        stats_filename(service_type) + ".tmp" for service_type in service_types
+    ]
+    patterns.append(combined_stats_filename + ".tmp")
+    if args.tile_store:
+        patterns.append(os.path.join(args.tile_store, "**", "*.tmp"))
+    removed = 0
+    for pattern in patterns:
+        for filename in glob.glob(pattern, recursive=True):
+            os.remove(filename)
+            removed += 1
+    if removed:
+        print("Removed", removed, "partial files left by the interrupted batch.")
+
+
+# Quarters are committed from the output threads, one at a time
+commit_lock = threading.Lock()
+
+
+def commit_when_written(
+    service_type: str,
+    year: int,
+    quarter: int,
+    location_quadkeys: dict,
+    location_stats: dict,
+    failed: list,
+) -> threading.Event:
+    # Merge a processed quarter's stats as soon as its output files are written, from the output thread that writes
+    # the last of them, so a quarter is committed even if the batch dies while the next one is being read. If writing
+    # the files fails, the quarter's stats are left out and it's added to failed, like a quarter that failed to
+    # process. Returns an event that is set once the quarter is committed or has failed.
+    quarter_year = str(year) + "Q" + str(quarter)
+    committed = threading.Event()
+
+    def commit(error):
+        with commit_lock:
+            try:
+                if error is not None:
+                    raise error
+                merge_quarter(
+                    service_type, year, quarter, location_quadkeys, location_stats
+                )
+            except Exception as e:
+                traceback.print_exception(type(e), e, e.__traceback__)
+                print(
+                    "Writing the files for",
+                    service_type,
+                    "quarter",
+                    quarter_year,
+                    "failed:",
+                    repr(e),
+                )
+                failed.append(f"{service_type} {quarter_year}")
+            finally:
+                committed.set()
+
+    output_stage.on_finished(f"{service_type} {quarter_year}", commit)
+    return committed
+
+
+def write_stats():
+    # Export the stats of each service type we processed from the store to its stats file, in quarter order, and the
+    # stats of all service types in the store to the combined stats file
+    for service_type in service_types:
+        stats_store.export_json(service_type, stats_filename(service_type))
+    combined_stats = {
+        service_type: stats_store.stats_dict(service_type)
+        for service_type in stats_store.services()
+    }
+    tmp_filename = combined_stats_filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(combined_stats, f, cls=NpEncoder)
+    os.replace(tmp_filename, combined_stats_filename)
+
+
+def main(argv: list = None) -> int:
+    # Run a batch, with command line arguments (sys.argv unless argv is given). Returns the exit code.
+    # Afterwards, even if the batch fails, the module is left ready to process quarters again: the batch's output stage
+    # and prefetcher are shut down, so a new output stage replaces them.
+    global prefetcher, checkpoint, output_stage
+    try:
+        return run_batch(argv)
+    finally:
+        output_stage.shutdown()
+        output_stage = OutputStage(args.output_threads)
+        if prefetcher is not None:
+            prefetcher.shutdown()
+            prefetcher = None
+        checkpoint = None
+
+
+def run_batch(argv: list = None) -> int:
+    # The batch run by main()
+    global prefetcher, checkpoint
+    if argv is None:
+        argv = sys.argv[1:]
+    # With --resume, run the interrupted batch again with its own arguments (and any new ones after them)
+    resumed = None
+    resume_args = parse_args(argv)
+    if resume_args.resume:
+        resumed = read_checkpoint(resume_args.checkpoint)
+        if resumed is None:
+            print("There is no batch to resume in", resume_args.checkpoint)
+            return 1
+        argv = resumed["argv"] + argv
+    configure(argv)
+    load_stats()
     # print batch timestamp
     print("Batch started at", datetime.now())
-    # Initialize the stats data structure, for all quarters, for all locations
-    stats = {}
-    # Get the list of quarters to process
-    quarters = make_quarters_list()
-    print("Processing", len(quarters), "quarters.")
+    tracer.start()
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    # The stats store holds the stats for all quarters, for all locations. With --preserve-stats it keeps the existing
+    # stats, and the quarters we process are saved into it.
+    # Get the list of quarters to process: those of the interrupted batch that aren't committed yet, with --resume
+    if resumed is not None:
+        job_quarters = [
+            (service_type, int(quarter_year[:4]), int(quarter_year[5:]))
+            for service_type, quarter_year in (
+                job.split()
+                for job in resumed["quarters"]
+                if job not in resumed["committed"]
+            )
+        ]
+        print(
+            "Resuming the batch started at",
+            resumed["started"],
+            "with",
+            len(job_quarters),
+            "of its",
+            len(resumed["quarters"]),
+            "quarters left.",
+        )
+        remove_partial_files()
+    else:
+        quarters = make_quarters_list()
+        print(
+            "Processing",
+            len(quarters),
+            "quarters of",
+            " and ".join(service_types),
+            "data.",
+        )
+        job_quarters = [
+            (service_type, year, quarter)
+            for year, quarter in quarters
+            for service_type in service_types
+        ]
     # Get the list of quadkey-locations
     location_quadkeys = read_quadkeys()
     print("Loaded", len(location_quadkeys), "locations.")
 
-    # Everything is initialized, now we can start processing
-    # For each quarter
-    for year, quarter in quarters:
-        # Save start time to calculate processing time
-        start_time = datetime.now()
-        quarter_year = str(year) + "Q" + str(quarter)
-        print("Processing quarter", quarter_year)
-        # For each file (for each Quarter) (multiquarter not implemented yet)
-        stats.update({quarter_year: {}})
-        # Get the file
-        tile_url = get_tile_url(fixed_or_mobile, year, quarter)  # all set by args
-        print("Downloading ", tile_url)
-        # Now we need to read the geodata file from the url. However, if we are just testing, we can read from a local file.
-        if testing:
-            all_tiles = gp.read_file("ookla-test-data.zip")
+    # Work out which locations to process in each quarter of each service type. Normally that's all of them, but with
+    # --incremental we skip the ones that are already in stats and up to date.
+    jobs = []
+    for service_type, year, quarter in job_quarters:
+        if args.incremental:
+            quarter_locations = locations_to_process(
+                service_type, year, quarter, location_quadkeys
+            )
         else:
-            all_tiles = gp.read_file(tile_url)
-        print("Downloaded ", len(all_tiles), "tiles.")
-
-        # Process into tiles
-        #   For each territory
-        for location in location_quadkeys:
-            print("Processing location", location)
-            stats[quarter_year].update({location: {}})
-            #     Filter into smaller tiles. To do this, we filter all_tiles for any that start with any of the territory's quadkeys.
-            location_tiles = all_tiles[
-                all_tiles["quadkey"].str.startswith(tuple(location_quadkeys[location]))
-            ]
-            #     Get statistics
-            download = (location_tiles["avg_d_kbps"].mean()) / 1000
-            upload = (location_tiles["avg_u_kbps"].mean()) / 1000
-            latency = location_tiles["avg_lat_ms"].mean()
-            tests = (location_tiles["tests"]).sum()
-            devices = location_tiles["devices"].sum()
+            quarter_locations = location_quadkeys
+        if quarter_locations:
+            jobs.append((service_type, year, quarter, quarter_locations))
+    if args.incremental:
+        print(
+            "Incremental: processing",
+            sum(len(job[3]) for job in jobs),
+            "quarter-locations in",
+            len(jobs),
+            "quarters.",
+        )
+    # Build the location index and read mask for every set of locations now, once for all quarters and service types
+    for job in jobs:
+        location_filter(job[3])
+
+    # The checkpoint, which is saved every time a quarter is committed (see merge_quarter)
+    if resumed is not None:
+        checkpoint = resumed
+    else:
+        unfinished = read_checkpoint(args.checkpoint)
+        if unfinished is not None:
             print(
-                f"{location} {year}Q{quarter} Stats...\n Download (mean Mbps) {download}\n Upload (mean Mbps) {upload}\n Latency (mean ms) {latency}\n Tests {tests} Devices {devices}\n"
+                "Replacing the checkpoint of an unfinished batch started at",
+                unfinished["started"],
             )
-            #     Add to stats data structure
-            stats[quarter_year][location].update(
-                {
-                    "download": download,
-                    "upload": upload,
-                    "latency": latency,
-                    "tests": tests,
-                    "devices": devices,
-                }
+        checkpoint = {
+            "argv": argv,
+            "started": str(datetime.now()),
+            "quarters": [
+                f"{service_type} {year}Q{quarter}"
+                for service_type, year, quarter, _ in jobs
+            ],
+            "committed": [],
+        }
+    save_checkpoint()
+
+    # Everything is initialized, now we can start processing
+    failed = []
+    workers = worker_count(args.workers, jobs)
+    if args.prefetch and not testing:
+        if workers > 1:
+            # The workers already download several quarters at once
+            print(
+                "Not prefetching, since the quarters are processed by",
+                workers,
+                "workers.",
             )
-            #     Write location_tiles to new file in geojson-datasets.
-            #     Filename should be {location}_ookla_{year}Q{quarter}.geojson
-            geojson_filename = f"{directory}/{fixed_or_mobile}/{location}_ookla_{year}Q{quarter}.geojson"
-            location_tiles.to_file(geojson_filename, driver="GeoJSON")
-            # End for each location
-        # Calculate processing time
-        end_time = datetime.now()
-        processing_time = end_time - start_time
-        print("Processing time for quarter", quarter_year, "was", processing_time)
-        # End for each quarter
+        else:
+            prefetcher = Prefetcher(
+                tile_cache,
+                [
+                    (
+                        get_tile_input(service_type, year, quarter),
+                        service_type,
+                        year,
+                        quarter,
+                    )
+                    for service_type, year, quarter, _ in jobs
+                ],
+                args.prefetch,
+                tracer,
+            )
+    if workers > 1:
+        failed = process_quarters_in_pool(jobs, workers, argv)
+    else:
+        # Quarters that have been processed, but may not be committed yet, since their files may still be being written
+        pending = []
+        try:
+            # For each quarter
+            for service_type, year, quarter, quarter_locations in jobs:
+                # For each file (for each Quarter); multi-quarter stats are rolled up from the store by stats_trends.py
+                location_stats = process_quarter(
+                    service_type,
+                    year,
+                    quarter,
+                    quarter_locations,
+                    wait_for_files=False,
+                )
+                pending.append(
+                    commit_when_written(
+                        service_type,
+                        year,
+                        quarter,
+                        quarter_locations,
+                        location_stats,
+                        failed,
+                    )
+                )
+                # Let the files of one quarter be written while the next one is processed, but no more than that,
+                # since the writes hold on to the quarter's tiles
+                while len(pending) > 1:
+                    pending.pop(0).wait()
+                # End for each quarter
+        finally:
+            # Wait for the last processed quarter to be committed, even if the batch is stopped by a failure or Ctrl-C
+            # in the next one
+            for committed in pending:
+                committed.wait()
+    output_stage.shutdown()
+    if prefetcher is not None:
+        prefetcher.shutdown()
 
-    #     Write all statistics to the file at stats_filename
-    with open(stats_filename, "w") as f:
-        json.dump(stats, f, cls=NpEncoder)
+    #     Export all statistics from the stats store to the stats files
+    write_stats()
+    stats_store.close()
     # print finished timestamp
     print("Batch finished at", datetime.now())
+    if failed:
+        print("These quarters failed and are not in the stats:", failed)
+        print("Run with --resume to retry them.")
+        return 1
+    # The batch is complete, so there's nothing to resume
+    os.remove(args.checkpoint)
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
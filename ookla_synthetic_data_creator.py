@@ -0,0 +1,155 @@
+# This script creates synthetic Ookla-style tile files of any size, for benchmarking and testing the batcher offline.
+# Unlike ookla_test_data_creator.py, it doesn't download anything, and it can create anything from a few thousand
+# tiles to a global-scale file with millions of tiles.
+#
+# The files have the same schema as the Ookla performance shapefiles (quadkey, avg_d_kbps, avg_u_kbps, avg_lat_ms,
+# tests, devices, and the tile polygon), zipped the same way. The tiles are zoom level 16, like Ookla's, and are
+# clustered the way real test data is: tiles are scattered around a number of "towns" with sizes that follow a
+# long-tailed (Zipf-like) distribution. Some of the towns are placed inside the locations in island_quadkeys.json, so
+# the batcher has something to find in them.
+#
+# To run this script from the command line:
+# python ookla_synthetic_data_creator.py --tiles 1000000 --output synthetic-1m.zip
+# Or write the file into a copy of the Ookla bucket layout, for use with the batcher's --base-url:
+# python ookla_synthetic_data_creator.py --tiles 1000000 --mirror-dir ookla-mirror --year 2021 --quarter 1
+# python ookla_data_quadkey_batcher.py --base-url file://$PWD/ookla-mirror --start_year 2021 --end_year 2021 --end_quarter 1
+# Shapefiles are limited to 2 GB per file, which is plenty for 10 million tiles.
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import geopandas as gp
+import numpy as np
+import shapely
+
+from quadkey_index import quadkey_to_tile, tile_bounds, tiles_to_quadkeys
+
+# Ookla tiles are zoom level 16
+tile_level = 16
+
+
+def make_tile_coordinates(
+    rng: np.random.Generator, tiles: int, location_quadkeys: dict, towns: int
+) -> tuple:
+    # Return unique (x, y) tile coordinates for about `tiles` tiles, clustered around towns
+    n = 2**tile_level
+    # Town centres: a third inside our locations (spread evenly over their prefixes), the rest anywhere between the
+    # latitudes where people mostly live
+    prefixes = [p for quadkeys in location_quadkeys.values() for p in quadkeys]
+    local_towns = min(towns // 3, len(prefixes) * 10) if prefixes else 0
+    centres_x = np.empty(towns)
+    centres_y = np.empty(towns)
+    for i in range(local_towns):
+        x, y, level = quadkey_to_tile(prefixes[i % len(prefixes)])
+        scale = 2 ** (tile_level - level)
+        centres_x[i] = (x + rng.random()) * scale
+        centres_y[i] = (y + rng.random()) * scale
+    centres_x[local_towns:] = rng.random(towns - local_towns) * n
+    centres_y[local_towns:] = (0.25 + rng.random(towns - local_towns) * 0.4) * n
+    # Town sizes (number of tiles) follow Zipf's law. We make extra tiles, since some land on the same spot.
+    weights = 1 / np.arange(1, towns + 1)
+    rng.shuffle(weights)
+    town_tiles = np.maximum(1, np.round(weights / weights.sum() * tiles * 1.5)).astype(
+        int
+    )
+    # Scatter each town's tiles around its centre; bigger towns spread out further
+    town = np.repeat(np.arange(towns), town_tiles)
+    spread = np.sqrt(town_tiles[town]) * 0.6 + 1
+    x = np.clip(centres_x[town] + rng.normal(0, 1, len(town)) * spread, 0, n - 1)
+    y = np.clip(centres_y[town] + rng.normal(0, 1, len(town)) * spread, 0, n - 1)
+    # Keep one of each tile, and stop at the requested number of tiles
+    xy = np.unique(x.astype(np.uint64) * n + y.astype(np.uint64))
+    xy = rng.permutation(xy)[:tiles]
+    return xy // n, xy % n
+
+
+def make_tiles(tiles: int, location_quadkeys: dict, seed: int = 0) -> gp.GeoDataFrame:
+    rng = np.random.default_rng(seed)
+    towns = max(10, tiles // 200)
+    x, y = make_tile_coordinates(rng, tiles, location_quadkeys, towns)
+    count = len(x)
+    # Speeds and latency are roughly log-normal; upload is usually a fraction of download
+    download = rng.lognormal(np.log(60000), 1.0, count)
+    upload = download * rng.lognormal(np.log(0.25), 0.7, count)
+    latency = rng.lognormal(np.log(25), 0.6, count)
+    # Most tiles have a handful of tests, a few have many
+    tests = rng.geometric(0.15, count) + rng.poisson(2, count)
+    devices = np.maximum(1, np.round(tests * rng.uniform(0.2, 1.0, count)))
+    west, south, east, north = tile_bounds(x, y, tile_level)
+    return gp.GeoDataFrame(
+        {
+            "quadkey": tiles_to_quadkeys(x, y, tile_level),
+            "avg_d_kbps": download.astype(np.int64),
+            "avg_u_kbps": upload.astype(np.int64),
+            "avg_lat_ms": latency.astype(np.int64),
+            "tests": tests.astype(np.int64),
+            "devices": devices.astype(np.int64),
+        },
+        geometry=shapely.box(west, south, east, north),
+        crs="EPSG:4326",
+    )
+
+
+def write_zipped_shapefile(tiles: gp.GeoDataFrame, zip_filename: str):
+    # Write tiles as a zipped shapefile, like the Ookla files (and ookla_test_data_creator.py)
+    name = os.path.splitext(os.path.basename(zip_filename))[0]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shapefile_dir = os.path.join(tmp_dir, name)
+        os.makedirs(shapefile_dir)
+        tiles.to_file(
+            os.path.join(shapefile_dir, name + ".shp"), driver="ESRI Shapefile"
+        )
+        archive = shutil.make_archive(shapefile_dir, "zip", shapefile_dir)
+        os.makedirs(os.path.dirname(os.path.abspath(zip_filename)), exist_ok=True)
+        shutil.move(archive, zip_filename)
+
+
+def mirror_path(mirror_dir: str, service_type: str, year: int, q: int) -> str:
+    # Where the file for this quarter goes in a local copy of the Ookla bucket (see get_tile_url in the batcher)
+    month = [1, 4, 7, 10][q - 1]
+    return os.path.join(
+        mirror_dir,
+        f"type={service_type}",
+        f"year={year}",
+        f"quarter={q}",
+        f"{year}-{month:02d}-01_performance_{service_type}_tiles.zip",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create synthetic Ookla tile files.")
+    parser.add_argument("--tiles", type=int, default=100000, help="Number of tiles.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument(
+        "--quadkeys",
+        default="island_quadkeys.json",
+        help="Locations to place some of the tiles in.",
+    )
+    parser.add_argument("--output", default=None, help="Zip file to write.")
+    parser.add_argument(
+        "--mirror-dir",
+        default=None,
+        help="Write the file into this copy of the Ookla bucket layout instead.",
+    )
+    parser.add_argument("--service", default="fixed", choices=["fixed", "mobile"])
+    parser.add_argument("--year", type=int, default=2021)
+    parser.add_argument("--quarter", type=int, default=1)
+    args = parser.parse_args()
+
+    with open(args.quadkeys) as f:
+        location_quadkeys = json.load(f)
+
+    if args.mirror_dir:
+        output = mirror_path(args.mirror_dir, args.service, args.year, args.quarter)
+    else:
+        output = args.output or f"ookla-synthetic-{args.tiles}.zip"
+
+    print("Creating", args.tiles, "synthetic tiles")
+    tiles = make_tiles(args.tiles, location_quadkeys, args.seed)
+    print("Writing", len(tiles), "tiles to", output)
+    write_zipped_shapefile(tiles, output)
+    print("Done at ", datetime.now())
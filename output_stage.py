@@ -0,0 +1,63 @@
+# Background output stage for ookla_data_quadkey_batcher.py (--output-threads).
+#
+# Once a quarter's tiles have been read and split up by location, writing each location's files (geojson and tile
+# store) doesn't depend on anything else, so the writes are handed to a thread pool and the batcher moves on to the
+# next quarter while they run. Writes are grouped by a key (the quarter), and finish(key) waits for a key's writes and
+# raises the first error, so the batcher only saves a quarter's stats once its files are written. Or on_finished(key,
+# callback) calls back as soon as the last of a key's writes is done, on the thread that did it, without waiting.
+#
+# With threads=0, every write runs right away in the calling thread, like before there was an output stage.
+
+import concurrent.futures
+import threading
+
+
+class OutputStage:
+    def __init__(self, threads: int):
+        self.executor = (
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=threads, thread_name_prefix="output"
+            )
+            if threads > 0
+            else None
+        )
+        # key -> futures of the writes submitted for it
+        self.pending = {}
+
+    def submit(self, key: str, function, *args):
+        if self.executor is None:
+            function(*args)
+            return
+        self.pending.setdefault(key, []).append(self.executor.submit(function, *args))
+
+    def finish(self, key: str):
+        # Wait for all of key's writes, and raise the first error, if any
+        futures = self.pending.pop(key, [])
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+    def on_finished(self, key: str, callback):
+        # Call callback(error) once all of key's writes are done, with the first error or None. It's called from the
+        # output thread that finishes the last write, or right away if they're all done already.
+        futures = self.pending.pop(key, [])
+        if not futures:
+            callback(None)
+            return
+        lock = threading.Lock()
+        remaining = [len(futures)]
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            errors = [future.exception() for future in futures if future.exception()]
+            callback(errors[0] if errors else None)
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,68 @@
+# Background download of the next quarters' archives, used by ookla_data_quadkey_batcher.py (--prefetch).
+#
+# Without it, every quarter is downloaded and then processed, so the CPU waits for the network and the network waits
+# for the CPU. A Prefetcher is given the archives the batcher will need, in order, and downloads them into the tile
+# cache on a background thread, at most depth archives ahead of the one being processed. When the batcher asks for an
+# archive that was prefetched, it only waits for whatever is left of its download.
+#
+# Only one archive downloads at a time, since the downloads share the same network connection. The depth bounds the
+# disk space used by archives that are downloaded but not processed yet. Archives that were prefetched but never asked
+# for (e.g. when the batch fails) are released again by shutdown, so the cache can evict them.
+
+import concurrent.futures
+
+
+class Prefetcher:
+    def __init__(self, tile_cache, upcoming: list, depth: int, tracer=None):
+        # upcoming is a list of (url, service_type, year, quarter), in the order the batcher will fetch them
+        self.tile_cache = tile_cache
+        self.upcoming = list(upcoming)
+        self.depth = depth
+        self.tracer = tracer
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="prefetch"
+        )
+        # cache key -> future of its download, and its (service_type, year, quarter)
+        self.futures = {}
+        self._fill()
+
+    def _fill(self):
+        # Start downloads until depth archives are downloading or waiting to be used
+        while self.upcoming and len(self.futures) < self.depth:
+            url, service_type, year, q = self.upcoming.pop(0)
+            key = self.tile_cache.make_key(service_type, year, q)
+            self.futures[key] = (
+                self.executor.submit(self._prefetch, url, service_type, year, q),
+                (service_type, year, q),
+            )
+
+    def _prefetch(self, url: str, service_type: str, year: int, q: int) -> str:
+        if self.tracer is None:
+            return self.tile_cache.fetch(url, service_type, year, q)
+        with self.tracer.span("prefetch", service=service_type, quarter=f"{year}Q{q}"):
+            return self.tile_cache.fetch(url, service_type, year, q)
+
+    def fetch(self, url: str, service_type: str, year: int, q: int) -> str:
+        # Like TileCache.fetch, but using the prefetched download if there is one. Either way, the next archives start
+        # downloading while this one is processed.
+        key = self.tile_cache.make_key(service_type, year, q)
+        future, _ = self.futures.pop(key, (None, None))
+        self.upcoming = [
+            item for item in self.upcoming if item[1:] != (service_type, year, q)
+        ]
+        self._fill()
+        if future is None:
+            return self.tile_cache.fetch(url, service_type, year, q)
+        return future.result()
+
+    def shutdown(self):
+        # Stop downloads that haven't started, and wait for the one in progress
+        self.upcoming = []
+        for future, _ in self.futures.values():
+            future.cancel()
+        self.executor.shutdown()
+        # The archives that were downloaded but never used aren't in use any more
+        for future, (service_type, year, q) in self.futures.values():
+            if not future.cancelled() and future.exception() is None:
+                self.tile_cache.release(service_type, year, q)
+        self.futures = {}
@@ -0,0 +1,219 @@
+# Quadkey prefix index used by ookla_data_quadkey_batcher.py to assign tiles to locations.
+#
+# Every Ookla tile has a quadkey, and every location in island_quadkeys.json is a list of quadkey prefixes.
+# Rather than scanning all of the tiles once per location with str.startswith, we work with quadkeys as integers:
+# each digit (0-3) is two bits, so a quadkey of up to 32 digits fits in a uint64, left-aligned like a z-order curve
+# position. Every quadkey that starts with a prefix then lies in one integer range, [prefix, prefix + 4^(32 - level)).
+#
+# LocationIndex converts the location prefixes into those ranges once. To locate a batch of tiles, their quadkeys are
+# decoded into integers in one vectorized pass (no Python strings per row), sorted once, and the tiles for each prefix
+# are found as a contiguous slice of the sorted keys with np.searchsorted. That is one sort (n log n) plus two binary
+# searches per prefix, instead of a string scan of every tile for every location.
+#
+# Each quadkey prefix is also a square tile on the map (see the Bing Maps tile system link in the batcher), so the
+# prefixes can be turned into lat/lon boxes. The batcher uses those boxes as a spatial filter when it reads the global
+# file, so that only the tiles near our locations are ever loaded.
+#
+# Likewise, every Ookla tile's polygon is just the square of its quadkey, so quadkey_polygons can build the polygons of
+# any number of tiles from their quadkeys, without reading them from the file.
+
+import numpy as np
+import shapely
+from shapely.geometry import box
+from shapely.ops import unary_union
+
+# Two bits per digit, so 32 digits fill a uint64
+max_level = 32
+
+
+def quadkey_digits(quadkeys) -> np.ndarray:
+    # The quadkeys as an (n, width) array of ASCII digits, with shorter quadkeys padded with zero bytes.
+    # Ookla quadkeys all have the same length, and Arrow (which pandas uses for strings when pyarrow is installed)
+    # already keeps same-length strings as one contiguous block of bytes, so we can usually just reshape that block
+    # without copying anything or touching the strings one by one.
+    try:
+        import pyarrow as pa
+
+        array = pa.array(quadkeys)
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks()
+        if (
+            pa.types.is_string(array.type) or pa.types.is_large_string(array.type)
+        ) and not array.null_count:
+            offset_type = np.int64 if pa.types.is_large_string(array.type) else np.int32
+            _, offsets, data = array.buffers()
+            offsets = np.frombuffer(offsets, dtype=offset_type)[
+                array.offset : array.offset + len(array) + 1
+            ]
+            lengths = np.diff(offsets)
+            if len(array) and np.all(lengths == lengths[0]) and lengths[0] <= max_level:
+                data = np.frombuffer(data, dtype=np.uint8)[offsets[0] : offsets[-1]]
+                return data.reshape(len(array), int(lengths[0]))
+    except ImportError:
+        pass
+    # Otherwise, copy the strings into a fixed-width byte array
+    raw = np.asarray(quadkeys, dtype=bytes)
+    if raw.dtype.itemsize > max_level:
+        raise ValueError(f"Quadkeys can have at most {max_level} digits")
+    return raw.view(np.uint8).reshape(len(raw), raw.dtype.itemsize)
+
+
+def encode_quadkeys(quadkeys) -> tuple:
+    # Decode quadkey strings into (keys, levels): uint64 keys, left-aligned to max_level digits, and uint8 levels
+    # (the number of digits). quadkeys can be any sequence of strings, e.g. the "quadkey" column of the tiles.
+    digits = quadkey_digits(quadkeys)
+    present = digits != 0
+    values = np.where(present, digits - np.uint8(ord("0")), 0).astype(np.uint8)
+    if np.any(values > 3):
+        raise ValueError("Quadkeys may only contain the digits 0, 1, 2 and 3")
+    levels = present.sum(axis=1).astype(np.uint8)
+    # Two bits per digit, a digit column at a time
+    keys = np.zeros(len(digits), dtype=np.uint64)
+    for column in range(digits.shape[1]):
+        keys = (keys << np.uint64(2)) | values[:, column]
+    keys <<= np.uint64(2 * (max_level - digits.shape[1]))
+    return keys, levels
+
+
+def prefix_range(prefix: str) -> tuple:
+    # The (first, last) keys, inclusive, of the quadkeys that start with prefix. (The end of the range is inclusive,
+    # because the exclusive end of the last range, "3333...", would not fit in a uint64.)
+    level = len(prefix)
+    first = int(prefix, 4) << (2 * (max_level - level)) if prefix else 0
+    last = first + 4 ** (max_level - level) - 1
+    return first, last
+
+
+class LocationIndex:
+    # Quadkey ranges for every location, computed once from location_quadkeys (as read by read_quadkeys)
+    def __init__(self, location_quadkeys: dict):
+        self.location_quadkeys = location_quadkeys
+        self.ranges = {}
+        for location, prefixes in location_quadkeys.items():
+            # Sorted, and without prefixes that are inside another of the location's prefixes
+            prefixes = sorted(set(prefixes))
+            prefixes = [
+                prefix
+                for prefix in prefixes
+                if not any(
+                    prefix != other and prefix.startswith(other) for other in prefixes
+                )
+            ]
+            firsts, lasts = zip(*map(prefix_range, prefixes)) if prefixes else ((), ())
+            self.ranges[location] = (
+                np.array(firsts, dtype=np.uint64),
+                np.array(lasts, dtype=np.uint64),
+                np.array([len(prefix) for prefix in prefixes], dtype=np.uint8),
+            )
+
+    def locate(self, quadkeys) -> dict:
+        # For each location, return the row positions (in original row order) of the quadkeys matching any of its
+        # prefixes.
+        keys, levels = encode_quadkeys(quadkeys)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        location_rows = {}
+        for location, (firsts, lasts, prefix_levels) in self.ranges.items():
+            starts = np.searchsorted(sorted_keys, firsts, side="left")
+            stops = np.searchsorted(sorted_keys, lasts, side="right")
+            rows = []
+            for start, stop, prefix_level in zip(starts, stops, prefix_levels):
+                range_rows = order[start:stop]
+                # A quadkey shorter than the prefix can share its key (e.g. "1" and "10"), but isn't inside it
+                rows.append(range_rows[levels[range_rows] >= prefix_level])
+            # Sorting puts the rows back in their original order
+            location_rows[location] = (
+                np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.intp)
+            )
+        return location_rows
+
+
+def locate_locations(quadkeys, location_quadkeys: dict) -> dict:
+    # Shortcut for a one-off LocationIndex(location_quadkeys).locate(quadkeys)
+    return LocationIndex(location_quadkeys).locate(quadkeys)
+
+
+def quadkey_to_tile(quadkey: str) -> tuple:
+    # Convert a quadkey to its (x, y, level) tile coordinates
+    x = y = 0
+    level = len(quadkey)
+    for i, digit in enumerate(quadkey):
+        bit = 1 << (level - i - 1)
+        digit = int(digit)
+        if digit & 1:
+            x |= bit
+        if digit & 2:
+            y |= bit
+    return x, y, level
+
+
+def keys_to_tiles(keys, level: int) -> tuple:
+    # The (x, y) tile coordinates of an array of quadkeys at level, as integers with two bits per digit, right-aligned
+    # (i.e. keys from encode_quadkeys, shifted right by 2 * (max_level - level))
+    keys = np.asarray(keys, dtype=np.uint64)
+    x = np.zeros(len(keys), dtype=np.uint64)
+    y = np.zeros(len(keys), dtype=np.uint64)
+    for i in range(level):
+        digit = (keys >> np.uint64(2 * (level - i - 1))) & np.uint64(3)
+        x = (x << np.uint64(1)) | (digit & np.uint64(1))
+        y = (y << np.uint64(1)) | (digit >> np.uint64(1))
+    return x, y
+
+
+def tiles_to_quadkeys(x, y, level: int) -> np.ndarray:
+    # The quadkeys of arrays of tile x and y coordinates (all at the same level), as an array of strings
+    x = np.asarray(x, dtype=np.uint64)
+    y = np.asarray(y, dtype=np.uint64)
+    digits = np.empty((len(x), level), dtype=np.uint8)
+    for i in range(level):
+        shift = np.uint64(level - i - 1)
+        digits[:, i] = ((x >> shift) & np.uint64(1)) | (
+            ((y >> shift) & np.uint64(1)) << np.uint64(1)
+        )
+    digits += ord("0")
+    return digits.view(f"S{level}").ravel().astype(str)
+
+
+def tile_bounds(x, y, level: int) -> tuple:
+    # Return the (west, south, east, north) lon/lat bounds of a tile.
+    # x and y can also be numpy arrays, to get the bounds of many tiles at once.
+    n = 2**level
+
+    def lat(tile_y):
+        return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * tile_y / n))))
+
+    return (x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+
+def quadkey_bounds(quadkey: str) -> tuple:
+    return tile_bounds(*quadkey_to_tile(quadkey))
+
+
+def quadkey_polygons(quadkeys) -> np.ndarray:
+    # The squares of an array of quadkeys (all of the same level), as shapely polygons, built all at once. The corners
+    # are in the same order as in the Ookla files: north-west, north-east, south-east, south-west.
+    keys, levels = encode_quadkeys(quadkeys)
+    if len(levels) and np.any(levels != levels[0]):
+        raise ValueError("The quadkeys must all have the same number of digits")
+    level = int(levels[0]) if len(levels) else max_level
+    x, y = keys_to_tiles(keys >> np.uint64(2 * (max_level - level)), level)
+    west, south, east, north = tile_bounds(x, y, level)
+    rings = np.stack(
+        [
+            np.stack([west, east, east, west, west], axis=-1),
+            np.stack([north, north, south, south, north], axis=-1),
+        ],
+        axis=-1,
+    )
+    return shapely.polygons(rings)
+
+
+def locations_mask(location_quadkeys: dict):
+    # The union of the boxes of every location prefix, for use as a spatial filter when reading tiles.
+    # Tiles that only touch the edge of a box will also pass the filter; LocationIndex.locate drops them later.
+    boxes = [
+        box(*quadkey_bounds(prefix))
+        for prefixes in location_quadkeys.values()
+        for prefix in prefixes
+    ]
+    return unary_union(boxes)
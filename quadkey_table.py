@@ -0,0 +1,284 @@
+# Memory-mapped quadkey table of a whole quarter's Ookla tiles, for ad-hoc region queries.
+#
+# The batcher only reads the tiles near the locations in island_quadkeys.json, so trying out a new location means
+# reading the global file again. Instead, a quarter can be indexed once, with every tile in it:
+# python quadkey_table.py --build --service fixed --quarter 2021Q1 [--cache-dir ookla-cache]
+# and then any region that is a set of quadkey prefixes can be queried in milliseconds:
+# python quadkey_table.py --service fixed --quarter 2021Q1 --prefix 1323 --prefix 13230
+# python quadkey_table.py --service fixed --quarter 2021Q1 --location guam --geojson guam.geojson
+# which prints the region's stats (see tile_stats.py), and can also save its tiles to a GeoJSON file.
+#
+# A table is a directory of numpy arrays, one per column, in quadkey order:
+#   quadkey-tables/
+#       service=fixed/
+#           quarter=2021Q1/
+#               key.npy          the quadkeys as uint64 integers (see quadkey_index.py)
+#               avg_d_kbps.npy   and the other Ookla columns (avg_u_kbps, avg_lat_ms, tests, devices)
+#               offsets.npy      the row where each quadkey prefix of index_level digits starts
+#               table.json       the source, row count and levels
+# The arrays are memory-mapped, so opening a table reads nothing, and the rows of a prefix are one contiguous slice of
+# every column. The offsets narrow a query down to the rows of the prefix's first index_level digits, and a binary
+# search of their keys does the rest, so a query only touches the pages of the rows it returns.
+#
+# The geometry isn't stored: every tile is the square of its quadkey, so it's rebuilt from the key when needed.
+# Building a table needs pyogrio and pyarrow, and sorts the whole quarter in memory (about 40 bytes per tile).
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from quadkey_index import (
+    encode_quadkeys,
+    keys_to_tiles,
+    max_level,
+    prefix_range,
+    quadkey_polygons,
+    tiles_to_quadkeys,
+)
+
+# Default directory for the tables
+tables_directory = "quadkey-tables"
+
+# The Ookla columns in a table, and their types
+table_columns = {
+    "avg_d_kbps": np.float64,
+    "avg_u_kbps": np.float64,
+    "avg_lat_ms": np.float64,
+    "tests": np.int64,
+    "devices": np.int64,
+}
+
+# Digits of the prefixes in the offset index: 4^8 = 65536 prefixes, so a 512 KB index
+index_level = 8
+
+
+def table_path(tables_dir: str, service_type: str, quarter_year: str) -> str:
+    return os.path.join(
+        tables_dir, f"service={service_type}", f"quarter={quarter_year}"
+    )
+
+
+def build_table(
+    source: str,
+    tables_dir: str,
+    service_type: str,
+    quarter_year: str,
+    batch_size: int = 1000000,
+) -> str:
+    # Index every tile in source (a path or url, like gp.read_file). Only the attributes are read, not the geometry.
+    # The table is written to a temporary directory first, so readers never see a partial table.
+    import pyogrio
+
+    keys = []
+    columns = {column: [] for column in table_columns}
+    levels = set()
+    with pyogrio.open_arrow(
+        source,
+        columns=["quadkey"] + list(table_columns),
+        read_geometry=False,
+        batch_size=batch_size,
+        use_pyarrow=True,
+    ) as (meta, reader):
+        for batch in reader:
+            batch_keys, batch_levels = encode_quadkeys(batch.column("quadkey"))
+            keys.append(batch_keys)
+            levels.update(np.unique(batch_levels).tolist())
+            for column, dtype in table_columns.items():
+                columns[column].append(
+                    batch.column(column).to_numpy(zero_copy_only=False).astype(dtype)
+                )
+    if len(levels) > 1:
+        # A shorter quadkey has the same key as its first child (e.g. "1" and "10"), so prefix slices would be wrong
+        raise ValueError(f"The quadkeys in {source} have different levels: {levels}")
+
+    keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.uint64)
+    order = np.argsort(keys, kind="stable")
+    path = table_path(tables_dir, service_type, quarter_year)
+    tmp_path = path + ".tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    keys = keys[order]
+    np.save(os.path.join(tmp_path, "key.npy"), keys)
+    for column, dtype in table_columns.items():
+        values = (
+            np.concatenate(columns[column])[order]
+            if keys.size
+            else np.empty(0, dtype=dtype)
+        )
+        np.save(os.path.join(tmp_path, f"{column}.npy"), values)
+    # offsets[i] is the first row whose key starts with prefix i (of index_level digits), and offsets[-1] the row count
+    prefixes = np.arange(4**index_level, dtype=np.uint64) << np.uint64(
+        2 * (max_level - index_level)
+    )
+    offsets = np.append(np.searchsorted(keys, prefixes, side="left"), len(keys))
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets.astype(np.int64))
+    with open(os.path.join(tmp_path, "table.json"), "w") as f:
+        json.dump(
+            {
+                "source": source,
+                "service": service_type,
+                "quarter": quarter_year,
+                "rows": len(keys),
+                "tile_level": levels.pop() if levels else None,
+                "index_level": index_level,
+                "columns": list(table_columns),
+            },
+            f,
+            indent=1,
+        )
+    if os.path.exists(path):
+        # Replace an older table of the same quarter
+        for filename in os.listdir(path):
+            os.remove(os.path.join(path, filename))
+        os.rmdir(path)
+    os.replace(tmp_path, path)
+    return path
+
+
+class QuadkeyTable:
+    # A table opened for queries. Nothing is read until a query touches it.
+    def __init__(self, tables_dir: str, service_type: str, quarter_year: str):
+        self.path = table_path(tables_dir, service_type, quarter_year)
+        with open(os.path.join(self.path, "table.json")) as f:
+            self.meta = json.load(f)
+        self.keys = np.load(os.path.join(self.path, "key.npy"), mmap_mode="r")
+        self.columns = {
+            column: np.load(os.path.join(self.path, f"{column}.npy"), mmap_mode="r")
+            for column in table_columns
+        }
+        self.offsets = np.load(os.path.join(self.path, "offsets.npy"), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def prefix_rows(self, prefix: str) -> slice:
+        # The rows of the tiles whose quadkeys start with prefix
+        if len(prefix) > (self.meta["tile_level"] or max_level):
+            return slice(0, 0)
+        first, last = prefix_range(prefix)
+        shift = 2 * (max_level - self.meta["index_level"])
+        start = int(self.offsets[first >> shift])
+        stop = int(self.offsets[(last >> shift) + 1])
+        if len(prefix) > self.meta["index_level"]:
+            # Only some of the rows of the prefix's first index_level digits: binary search their keys
+            keys = self.keys[start:stop]
+            stop = start + int(np.searchsorted(keys, np.uint64(last), side="right"))
+            start += int(np.searchsorted(keys, np.uint64(first), side="left"))
+        return slice(start, stop)
+
+    def query(self, prefixes: list) -> pd.DataFrame:
+        # The tiles whose quadkeys start with any of prefixes, in quadkey order, with the Ookla columns and quadkey
+        # Prefixes inside another of the prefixes would give the same tiles twice
+        prefixes = sorted(set(prefixes))
+        prefixes = [
+            prefix
+            for prefix in prefixes
+            if not any(
+                prefix != other and prefix.startswith(other) for other in prefixes
+            )
+        ]
+        slices = [self.prefix_rows(prefix) for prefix in prefixes]
+        keys = np.concatenate([self.keys[rows] for rows in slices] or [[]]).astype(
+            np.uint64
+        )
+        tile_level = self.meta["tile_level"] or max_level
+        x, y = keys_to_tiles(
+            keys >> np.uint64(2 * (max_level - tile_level)), tile_level
+        )
+        tiles = pd.DataFrame({"quadkey": tiles_to_quadkeys(x, y, tile_level)})
+        for column, values in self.columns.items():
+            tiles[column] = np.concatenate(
+                [values[rows] for rows in slices] or [[]]
+            ).astype(table_columns[column])
+        return tiles
+
+
+def tiles_geodataframe(tiles: pd.DataFrame):
+    # Add the tile squares to tiles from query, as a GeoDataFrame like the Ookla tiles
+    import geopandas as gp
+
+    return gp.GeoDataFrame(
+        tiles, geometry=quadkey_polygons(tiles["quadkey"]), crs="EPSG:4326"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build or query the quadkey table of a quarter."
+    )
+    parser.add_argument("--tables-dir", default=tables_directory)
+    parser.add_argument("--service", choices=["fixed", "mobile"], default="fixed")
+    parser.add_argument("--quarter", required=True, help="e.g. 2021Q1")
+    parser.add_argument(
+        "--build",
+        action="store_true",
+        help="Build the quarter's table from the Ookla file, instead of querying it.",
+    )
+    parser.add_argument(
+        "--source",
+        default=None,
+        help="With --build: the file to index (default: the quarter's Ookla url).",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="With --build: download the Ookla file through this cache (see tile_cache.py).",
+    )
+    parser.add_argument("--prefix", action="append", help="e.g. 1323; repeatable")
+    parser.add_argument(
+        "--location",
+        action="append",
+        help="A location in island_quadkeys.json, e.g. guam; repeatable",
+    )
+    parser.add_argument(
+        "--geojson", default=None, help="Also save the tiles to this GeoJSON file."
+    )
+    args = parser.parse_args()
+
+    if args.build:
+        source = args.source
+        if source is None:
+            from ookla_data_quadkey_batcher import get_tile_url
+
+            year, q = (int(part) for part in args.quarter.split("Q"))
+            source = get_tile_url(args.service, year, q)
+            if args.cache_dir:
+                from tile_cache import TileCache
+
+                source = TileCache(args.cache_dir).fetch(source, args.service, year, q)
+        start = time.perf_counter()
+        path = build_table(source, args.tables_dir, args.service, args.quarter)
+        print(
+            "Indexed",
+            len(QuadkeyTable(args.tables_dir, args.service, args.quarter)),
+            "tiles into",
+            path,
+            f"in {time.perf_counter() - start:.1f}s",
+        )
+    else:
+        from tile_stats import TileStats
+
+        # The region: the given prefixes, and those of the given locations
+        prefixes = list(args.prefix or [])
+        if args.location:
+            from ookla_data_quadkey_batcher import read_quadkeys
+
+            location_quadkeys = read_quadkeys()
+            for location in args.location:
+                prefixes.extend(location_quadkeys[location])
+        if not prefixes:
+            parser.error("Give at least one --prefix or --location to query")
+        start = time.perf_counter()
+        table = QuadkeyTable(args.tables_dir, args.service, args.quarter)
+        tiles = table.query(prefixes)
+        query_ms = (time.perf_counter() - start) * 1000
+        print(json.dumps(TileStats().update(tiles).stats(), indent=1))
+        print(f"{len(tiles)} of {len(table)} tiles, in {query_ms:.1f} ms")
+        if args.geojson:
+            from geojson_writer import write_geojson
+
+            write_geojson(tiles_geodataframe(tiles), args.geojson)
+            print("Wrote", args.geojson)
@@ -0,0 +1,256 @@
+# SQLite store for the stats computed by ookla_data_quadkey_batcher.py (--stats-db).
+#
+# The stats used to live in nested quarter -> location -> metric json files (stats_fixed.json and stats_mobile.json),
+# which had to be loaded and walked in full by everything that used them. The store keeps them in one tidy table
+# instead, with a row per service type, quarter and location:
+#   service, quarter, location        e.g. "fixed", "2021Q1", "guam"
+#   download, upload, latency, ...    the stats (see stats_columns, and TileStats.stats() in tile_stats.py)
+#   input, quadkeys, version          what the stats were computed from (the manifest, for --incremental)
+#   aggregates                        the mergeable TileStats behind the stats, as json
+# with indexes on location and on quarter, so plots and queries can read just the rows they need, e.g. with read_stats
+# or from the command line:
+# python stats_store.py --service fixed --location guam
+#
+# Each processed quarter is upserted in one transaction, so the store is never left with half a quarter, and the
+# quarters of an incremental run are saved as soon as they are done. The json files are still written, as an export
+# of the store (export_json), in the same format as before. SQLite doesn't store NaN, so missing stats are NULL in the
+# store and NaN again in the export.
+#
+# This only needs the standard library; read_stats also needs pandas.
+
+import argparse
+import json
+import math
+import os
+import sqlite3
+
+# Default filename of the store
+stats_db_filename = "stats.sqlite"
+
+# The stats columns, in the order of TileStats.stats(). Stats from before TileStats only have the first five.
+original_stats_columns = ["download", "upload", "latency", "tests", "devices"]
+stats_columns = original_stats_columns + [
+    "tiles",
+    "download_weighted",
+    "upload_weighted",
+    "latency_weighted",
+    "download_median",
+    "upload_median",
+    "latency_median",
+]
+manifest_columns = ["input", "quadkeys", "version"]
+
+schema = f"""
+CREATE TABLE IF NOT EXISTS stats (
+    service TEXT NOT NULL,
+    quarter TEXT NOT NULL,
+    location TEXT NOT NULL,
+    {", ".join(f"{column} {'INTEGER' if column in ('tests', 'devices', 'tiles') else 'REAL'}" for column in stats_columns)},
+    input TEXT,
+    quadkeys TEXT,
+    version INTEGER,
+    aggregates TEXT,
+    PRIMARY KEY (service, quarter, location)
+);
+CREATE INDEX IF NOT EXISTS stats_location ON stats (location, quarter);
+CREATE INDEX IF NOT EXISTS stats_quarter ON stats (quarter);
+"""
+
+
+def sql_value(value):
+    # NaN (e.g. the mean of no tiles) is stored as NULL
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+class StatsStore:
+    def __init__(self, filename: str = stats_db_filename):
+        self.filename = filename
+        # The batcher commits quarters from its output threads (one at a time), not just the thread that opened it
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    def services(self) -> list:
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT DISTINCT service FROM stats ORDER BY service"
+            )
+        ]
+
+    def upsert_quarter(self, service_type: str, quarter_year: str, rows: list):
+        # Insert or replace the stats of some locations in one quarter, all in one transaction.
+        # rows is a list of (location, stats, manifest entry or None, aggregates or None).
+        columns = stats_columns + manifest_columns + ["aggregates"]
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns)
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT INTO stats (service, quarter, location, {', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * (len(columns) + 3))}) "
+                f"ON CONFLICT (service, quarter, location) DO UPDATE SET {updates}",
+                [
+                    [service_type, quarter_year, location]
+                    + [
+                        sql_value(location_stats.get(column))
+                        for column in stats_columns
+                    ]
+                    + [(entry or {}).get(column) for column in manifest_columns]
+                    + [json.dumps(aggregates) if aggregates is not None else None]
+                    for location, location_stats, entry, aggregates in rows
+                ],
+            )
+
+    def clear(self, service_type: str):
+        # Remove all of a service type's stats
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM stats WHERE service = ?", (service_type,)
+            )
+
+    def manifest(self, service_type: str, quarter_year: str) -> dict:
+        # location -> manifest entry, for the locations of a quarter that have stats
+        return {
+            location: {"input": input, "quadkeys": quadkeys, "version": version}
+            for location, input, quadkeys, version in self.connection.execute(
+                "SELECT location, input, quadkeys, version FROM stats WHERE service = ? AND quarter = ?",
+                (service_type, quarter_year),
+            )
+            if version is not None
+        }
+
+    def aggregates(self, service_type: str, quarter_year: str = None) -> dict:
+        # quarter -> location -> aggregates (TileStats.to_dict()), for one quarter or all of them
+        query = "SELECT quarter, location, aggregates FROM stats WHERE service = ? AND aggregates IS NOT NULL"
+        parameters = [service_type]
+        if quarter_year is not None:
+            query += " AND quarter = ?"
+            parameters.append(quarter_year)
+        aggregates = {}
+        for quarter, location, state in self.connection.execute(
+            query + " ORDER BY quarter, rowid", parameters
+        ):
+            aggregates.setdefault(quarter, {})[location] = json.loads(state)
+        return aggregates
+
+    def quarters_without_aggregates(self, service_type: str) -> list:
+        # The quarters with stats but no aggregates for some of their locations, e.g. those imported from json files
+        # that had no aggregates
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT DISTINCT quarter FROM stats WHERE service = ? AND aggregates IS NULL ORDER BY quarter",
+                [service_type],
+            )
+        ]
+
+    def stats_dict(self, service_type: str) -> dict:
+        # The stats of a service type in the nested format of stats_fixed.json: quarter -> location -> stats.
+        # Rows computed by TileStats (which always have tiles) get every stats column, older rows the original ones.
+        stats = {}
+        for quarter, location, *row in self.connection.execute(
+            f"SELECT quarter, location, {', '.join(stats_columns)} FROM stats WHERE service = ? ORDER BY quarter, rowid",
+            (service_type,),
+        ):
+            values = dict(zip(stats_columns, row))
+            columns = (
+                stats_columns if values["tiles"] is not None else original_stats_columns
+            )
+            stats.setdefault(quarter, {})[location] = {
+                column: math.nan if values[column] is None else values[column]
+                for column in columns
+            }
+        return stats
+
+    def export_json(self, service_type: str, json_filename: str):
+        # Write a service type's stats to a json file like stats_fixed.json. The file is replaced atomically.
+        tmp_filename = json_filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(self.stats_dict(service_type), f)
+        os.replace(tmp_filename, json_filename)
+
+    def import_json(
+        self,
+        service_type: str,
+        stats: dict,
+        manifest: dict = None,
+        aggregates: dict = None,
+    ):
+        # Add stats (and optionally their manifest and aggregates) in the format of the old json files
+        manifest = manifest or {}
+        aggregates = aggregates or {}
+        for quarter_year, quarter_stats in stats.items():
+            self.upsert_quarter(
+                service_type,
+                quarter_year,
+                [
+                    (
+                        location,
+                        location_stats,
+                        manifest.get(quarter_year, {}).get(location),
+                        aggregates.get(quarter_year, {}).get(location),
+                    )
+                    for location, location_stats in quarter_stats.items()
+                ],
+            )
+
+
+def read_stats(
+    filename: str = stats_db_filename,
+    service_type: str = None,
+    locations: list = None,
+    quarters: list = None,
+    columns: list = None,
+):
+    # Read the matching rows of the store into a pandas DataFrame with service, quarter, location and the stats
+    # columns (or just the given columns). Leave out service_type, locations or quarters to read all of them.
+    import pandas as pd
+
+    conditions = []
+    parameters = []
+    if service_type is not None:
+        conditions.append("service = ?")
+        parameters.append(service_type)
+    for column, values in (("location", locations), ("quarter", quarters)):
+        if values is not None:
+            conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+            parameters.extend(values)
+    query = f"SELECT service, quarter, location, {', '.join(columns or stats_columns)} FROM stats"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    with sqlite3.connect(filename) as connection:
+        return pd.read_sql_query(
+            query + " ORDER BY service, quarter, rowid", connection, params=parameters
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query or export the stats store.")
+    parser.add_argument("--stats-db", default=stats_db_filename)
+    parser.add_argument("--service", choices=["fixed", "mobile"], default=None)
+    parser.add_argument("--location", action="append", help="e.g. guam; repeatable")
+    parser.add_argument("--quarter", action="append", help="e.g. 2021Q1; repeatable")
+    parser.add_argument(
+        "--export-json",
+        action="store_true",
+        help="Write stats_fixed.json and stats_mobile.json from the store instead.",
+    )
+    args = parser.parse_args()
+
+    if args.export_json:
+        store = StatsStore(args.stats_db)
+        for service_type in [args.service] if args.service else store.services():
+            json_filename = f"stats_{service_type}.json"
+            store.export_json(service_type, json_filename)
+            print("Wrote", json_filename)
+        store.close()
+    else:
+        print(
+            read_stats(args.stats_db, args.service, args.location, args.quarter).to_csv(
+                index=False
+            ),
+            end="",
+        )
@@ -0,0 +1,256 @@
+# Multi-quarter stats and trends, computed from the aggregates in the stats store (see stats_store.py).
+#
+# The store keeps the mergeable TileStats behind every quarter's stats (see tile_stats.py), so the stats of any set of
+# quarters can be computed from them exactly, without reading any tiles again. rollup computes them for every location
+# over one of these periods:
+#   quarter    each quarter on its own (the same stats as the store)
+#   annual     the quarters of each calendar year, e.g. "2021"
+#   rolling4   each quarter and the three before it, labelled by the last one, e.g. "2021Q3" for 2020Q4 - 2021Q3
+# along with the number of quarters that went into each period (a year or window can have fewer than four, at the
+# start and end of the data), and, with yoy=True, the change of each stat from a year earlier, as a fraction (e.g.
+# download_yoy = 0.25 for 25% faster than a year before).
+#
+# Stats imported from json files without aggregates (from before TileStats) can't be rolled up, so store_rollup raises a
+# ValueError naming the quarters to process again, rather than leaving them out.
+#
+# The TileStats totals are added up with one groupby over every quarter, location and period, and the medians come from
+# adding up the sketches' buckets the same way, so every location and period is computed in one pass.
+# From the command line:
+# python stats_trends.py --service fixed --period annual --yoy [--location guam]
+# prints the rollup as CSV.
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from stats_store import StatsStore, stats_columns, stats_db_filename
+from tile_stats import metric_columns, metric_scale
+
+periods = ["quarter", "annual", "rolling4"]
+
+# The bucket of a sketch's zero_weight, which sorts before every other bucket
+zero_bucket = np.iinfo(np.int64).min
+
+
+def quarter_index(quarter_year: str) -> int:
+    # "2021Q1" -> a count of quarters, so that consecutive quarters are consecutive numbers
+    year, q = quarter_year.split("Q")
+    return int(year) * 4 + int(q) - 1
+
+
+def aggregates_frames(aggregates: dict) -> tuple:
+    # Flatten the aggregates (quarter -> location -> TileStats.to_dict()) into two frames:
+    #   totals    a row per quarter and location, with tiles, tests, devices and every metric's totals
+    #   buckets   a row per quarter, location, metric and sketch bucket, with its weight
+    # and return them with the sketches' relative accuracy
+    totals = []
+    buckets = []
+    relative_accuracy = set()
+    for quarter_year, location_aggregates in aggregates.items():
+        index = quarter_index(quarter_year)
+        for location, state in location_aggregates.items():
+            row = {
+                "quarter_index": index,
+                "location": location,
+                "tiles": state["tiles"],
+                "tests": state["tests"],
+                "devices": state["devices"],
+            }
+            for metric, metric_totals in state["metrics"].items():
+                for key, value in metric_totals.items():
+                    row[f"{metric}_{key}"] = value
+            totals.append(row)
+            for metric, sketch in state["sketches"].items():
+                relative_accuracy.add(sketch["relative_accuracy"])
+                if sketch["zero_weight"]:
+                    buckets.append(
+                        (index, location, metric, zero_bucket, sketch["zero_weight"])
+                    )
+                buckets.extend(
+                    (index, location, metric, int(bucket), weight)
+                    for bucket, weight in sketch["bins"].items()
+                )
+    if len(relative_accuracy) > 1:
+        raise ValueError("The sketches have different relative accuracies")
+    return (
+        pd.DataFrame(totals),
+        pd.DataFrame(
+            buckets,
+            columns=["quarter_index", "location", "metric", "bucket", "weight"],
+        ),
+        relative_accuracy.pop() if relative_accuracy else 0.01,
+    )
+
+
+def period_windows(quarter_indexes, period: str) -> pd.DataFrame:
+    # Which period windows each quarter belongs to: a row per (quarter_index, window)
+    quarter_indexes = np.unique(quarter_indexes)
+    if period == "quarter":
+        return pd.DataFrame(
+            {"quarter_index": quarter_indexes, "window": quarter_indexes}
+        )
+    if period == "annual":
+        return pd.DataFrame(
+            {"quarter_index": quarter_indexes, "window": quarter_indexes // 4}
+        )
+    if period == "rolling4":
+        # Every quarter is in the windows ending with it and the three quarters after it, if there are any
+        windows = pd.DataFrame(
+            {
+                "quarter_index": np.repeat(quarter_indexes, 4),
+                "window": np.repeat(quarter_indexes, 4)
+                + np.tile(np.arange(4), len(quarter_indexes)),
+            }
+        )
+        return windows[windows["window"].isin(quarter_indexes)]
+    raise ValueError(f"Period must be one of {periods}")
+
+
+def window_label(windows, period: str) -> list:
+    if period == "annual":
+        return [str(window) for window in windows]
+    return [f"{window // 4}Q{window % 4 + 1}" for window in windows]
+
+
+def window_medians(buckets: pd.DataFrame, relative_accuracy: float) -> pd.DataFrame:
+    # The median of every window, location and metric, from the weights of their buckets, like QuantileSketch.quantile
+    keys = ["window", "location", "metric"]
+    buckets = (
+        buckets.groupby(keys + ["bucket"], sort=False)["weight"]
+        .sum()
+        .reset_index()
+        .sort_values(keys + ["bucket"])
+    )
+    groups = buckets.groupby(keys, sort=False)["weight"]
+    cumulative = groups.cumsum()
+    rank = 0.5 * groups.transform("sum")
+    # The first bucket that reaches the middle, or the last one (in case of rounding)
+    reached = buckets[(cumulative >= rank) & (rank > 0)].groupby(keys).head(1)
+    last = buckets[rank > 0].groupby(keys).tail(1)
+    medians = pd.concat([reached, last]).drop_duplicates(keys)
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    medians["median"] = np.where(
+        medians["bucket"] == zero_bucket,
+        0.0,
+        2 * gamma ** medians["bucket"].astype(float) / (gamma + 1),
+    )
+    return medians.pivot_table(
+        index=["window", "location"], columns="metric", values="median"
+    )
+
+
+def year_over_year(rollup: pd.DataFrame, period: str) -> pd.DataFrame:
+    # Add the change of every stat from a year earlier, as a fraction, e.g. download_yoy
+    previous = rollup[["window", "location"] + stats_columns].copy()
+    previous["window"] += 1 if period == "annual" else 4
+    merged = rollup.merge(
+        previous, on=["window", "location"], how="left", suffixes=("", "_previous")
+    )
+    for column in stats_columns:
+        merged[f"{column}_yoy"] = (
+            merged[column] / merged[f"{column}_previous"] - 1
+        ).replace([np.inf, -np.inf], np.nan)
+    return merged.drop(columns=[f"{column}_previous" for column in stats_columns])
+
+
+def rollup(
+    aggregates: dict, period: str = "quarter", yoy: bool = False
+) -> pd.DataFrame:
+    # The stats of every location over every period, from the aggregates (quarter -> location -> TileStats.to_dict()),
+    # with columns period, location, quarters and the stats columns (and their _yoy changes, with yoy=True)
+    totals, buckets, relative_accuracy = aggregates_frames(aggregates)
+    if not len(totals):
+        return pd.DataFrame(columns=["period", "location", "quarters"] + stats_columns)
+    windows = period_windows(totals["quarter_index"], period)
+
+    # Add up the totals of the quarters in each window
+    totals = totals.merge(windows, on="quarter_index")
+    sums = (
+        totals.drop(columns="quarter_index")
+        .groupby(["window", "location"], sort=True)
+        .agg(["sum", "size"])
+    )
+    quarters = sums[("tiles", "size")]
+    sums = sums.xs("sum", axis=1, level=1)
+    # and their sketches
+    medians = window_medians(
+        buckets.merge(windows, on="quarter_index"), relative_accuracy
+    ).reindex(sums.index)
+
+    # The stats, like TileStats.stats()
+    stats = pd.DataFrame(index=sums.index)
+    for metric in metric_columns:
+        count = sums[f"{metric}_count"]
+        stats[metric] = (sums[f"{metric}_sum"] / count / metric_scale[metric]).where(
+            count > 0
+        )
+    for column in ["tests", "devices", "tiles"]:
+        stats[column] = sums[column].astype(np.int64)
+    for metric in metric_columns:
+        weight = sums[f"{metric}_weight"]
+        stats[f"{metric}_weighted"] = (
+            sums[f"{metric}_weighted_sum"] / weight / metric_scale[metric]
+        ).where(weight > 0)
+    for metric in metric_columns:
+        if metric in medians:
+            stats[f"{metric}_median"] = medians[metric] / metric_scale[metric]
+        else:
+            stats[f"{metric}_median"] = np.nan
+    stats["quarters"] = quarters
+    stats = stats.reset_index()
+
+    if yoy:
+        stats = year_over_year(stats, period)
+    stats.insert(0, "period", window_label(stats["window"], period))
+    columns = ["period", "location", "quarters"] + stats_columns
+    if yoy:
+        columns += [f"{column}_yoy" for column in stats_columns]
+    return stats[columns]
+
+
+def store_rollup(
+    filename: str = stats_db_filename,
+    service_type: str = "fixed",
+    period: str = "quarter",
+    yoy: bool = False,
+) -> pd.DataFrame:
+    # rollup of a service type's aggregates in the stats store. Raises ValueError if there are none, or some quarters
+    # have no aggregates.
+    store = StatsStore(filename)
+    try:
+        missing = store.quarters_without_aggregates(service_type)
+        if missing:
+            raise ValueError(
+                f"The {service_type} stats of {', '.join(missing)} in {filename} have no aggregates (they were "
+                "imported from json files), so they can't be rolled up. Process those quarters again with "
+                "ookla_data_quadkey_batcher.py."
+            )
+        aggregates = store.aggregates(service_type)
+        if not aggregates:
+            raise ValueError(f"There are no {service_type} stats in {filename}")
+        return rollup(aggregates, period, yoy)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Multi-quarter stats and trends from the stats store."
+    )
+    parser.add_argument("--stats-db", default=stats_db_filename)
+    parser.add_argument("--service", choices=["fixed", "mobile"], default="fixed")
+    parser.add_argument("--period", choices=periods, default="annual")
+    parser.add_argument(
+        "--yoy", action="store_true", help="Add the change from a year earlier."
+    )
+    parser.add_argument("--location", action="append", help="e.g. guam; repeatable")
+    args = parser.parse_args()
+
+    try:
+        trends = store_rollup(args.stats_db, args.service, args.period, args.yoy)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.location:
+        trends = trends[trends["location"].isin(args.location)]
+    print(trends.to_csv(index=False), end="")
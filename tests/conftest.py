@@ -0,0 +1,21 @@
+# Shared setup for the tests: the scripts are run from the repo root, so make them importable, and give each test a
+# scratch directory set up like the repo (island_quadkeys.json and the output directories) to run the batcher in.
+
+import os
+import shutil
+import sys
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+batcher_script = os.path.join(repo_dir, "ookla_data_quadkey_batcher.py")
+
+
+@pytest.fixture
+def work_dir(tmp_path):
+    shutil.copy(os.path.join(repo_dir, "island_quadkeys.json"), tmp_path)
+    for service_type in ["fixed", "mobile"]:
+        os.makedirs(tmp_path / "geojson-datasets" / service_type)
+    return tmp_path
@@ -0,0 +1,79 @@
+# A batch that is killed while it reads its second quarter has already committed the first, so --resume skips it.
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from conftest import batcher_script
+from ookla_synthetic_data_creator import make_tiles, mirror_path, write_zipped_shapefile
+
+batch_args = [
+    "--start_year",
+    "2021",
+    "--start_quarter",
+    "1",
+    "--end_year",
+    "2021",
+    "--end_quarter",
+    "2",
+]
+
+
+def read_committed(checkpoint_path) -> list:
+    # The committed quarters in the checkpoint, or [] if it isn't there (or is being replaced) yet
+    try:
+        with open(checkpoint_path) as f:
+            return json.load(f)["committed"]
+    except (OSError, ValueError):
+        return []
+
+
+def test_resume_skips_quarter_committed_before_kill(work_dir):
+    with open(work_dir / "island_quadkeys.json") as f:
+        location_quadkeys = json.load(f)
+    mirror_dir = str(work_dir / "mirror")
+    write_zipped_shapefile(
+        make_tiles(2000, location_quadkeys, seed=1),
+        mirror_path(mirror_dir, "fixed", 2021, 1),
+    )
+    # The second quarter's file is a FIFO with no writer, so reading it blocks until the batch is killed
+    q2_path = mirror_path(mirror_dir, "fixed", 2021, 2)
+    os.makedirs(os.path.dirname(q2_path))
+    os.mkfifo(q2_path)
+
+    base_url = ["--base-url", "file://" + mirror_dir]
+    checkpoint_path = work_dir / "batch-checkpoint.json"
+    batch = subprocess.Popen(
+        [sys.executable, batcher_script] + base_url + batch_args,
+        cwd=work_dir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 120
+        while "fixed 2021Q1" not in read_committed(checkpoint_path):
+            assert batch.poll() is None, "the batch ended before it was killed"
+            assert time.monotonic() < deadline, "the first quarter was never committed"
+            time.sleep(0.2)
+    finally:
+        batch.send_signal(signal.SIGKILL)
+        batch.wait()
+
+    os.remove(q2_path)
+    write_zipped_shapefile(make_tiles(2000, location_quadkeys, seed=2), q2_path)
+    resumed = subprocess.run(
+        [sys.executable, batcher_script, "--resume"],
+        cwd=work_dir,
+        capture_output=True,
+        text=True,
+    )
+    assert resumed.returncode == 0, resumed.stderr
+    assert "with 1 of its 2 quarters left" in resumed.stdout
+    assert "quarter 2021Q1" not in resumed.stdout
+    assert "quarter 2021Q2" in resumed.stdout
+    assert not checkpoint_path.exists()
+    with open(work_dir / "stats_fixed.json") as f:
+        assert sorted(json.load(f)) == ["2021Q1", "2021Q2"]
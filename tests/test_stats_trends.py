@@ -0,0 +1,40 @@
+# Rolling up a stats store that only has stats imported from the old json files, without their aggregates.
+
+import pytest
+
+from bokeh_stats import load_stats
+from stats_store import StatsStore
+from stats_trends import store_rollup
+
+legacy_stats = {
+    quarter: {
+        "guam": {
+            "download": 28.6,
+            "upload": 4.7,
+            "latency": 32.0,
+            "tests": 9760,
+            "devices": 3018,
+        }
+    }
+    for quarter in ["2020Q4", "2021Q1"]
+}
+
+
+def test_rollup_of_legacy_stats_names_the_quarters(tmp_path):
+    filename = str(tmp_path / "stats.sqlite")
+    store = StatsStore(filename)
+    store.import_json("fixed", legacy_stats)
+    store.close()
+    with pytest.raises(ValueError, match="2020Q4, 2021Q1"):
+        store_rollup(filename, "fixed", "annual")
+    with pytest.raises(ValueError, match="2020Q4, 2021Q1"):
+        load_stats("fixed", None, "rolling4", filename)
+    # The quarterly stats are still there
+    assert len(load_stats("fixed", None, "quarter", filename)) == 2
+
+
+def test_rollup_of_empty_store(tmp_path):
+    filename = str(tmp_path / "stats.sqlite")
+    StatsStore(filename).close()
+    with pytest.raises(ValueError, match="no mobile stats"):
+        store_rollup(filename, "mobile", "annual")
@@ -0,0 +1,260 @@
+# Local download cache for the quarterly Ookla tile archives, used by ookla_data_quadkey_batcher.py (--cache-dir).
+#
+# Each quarterly archive is hundreds of MB, and without a cache the batcher fetches it again on every run.
+# The cache keeps one archive per service type and quarter, e.g. "fixed/2021Q1", in a directory like this:
+#   cache_dir/
+#       index.json          key -> url, sha256, etag, size, last_used, users
+#       index.json.lock     locked while a process updates the index
+#       objects/<sha256>.zip
+# Archives are stored by the sha256 of their contents (content-addressed), so a corrupt or truncated file can be
+# detected by hashing it again (verify=True), and identical archives are only stored once.
+#
+# When an archive is downloaded and the server sends a plain MD5 ETag (as S3 does for single-part uploads), the
+# downloaded bytes are checked against it. Multipart ETags (with a "-") are not MD5s of the content and are only recorded.
+#
+# If max_bytes is set, the least recently used archives are evicted after each fetch and release until the cache fits.
+# Archives that are in use (fetched, and not released yet) are not evicted, so a download in the background (see
+# prefetch.py) or in another batcher process (--workers) can't remove the archive that is being read. The processes using an archive
+# are counted in its index entry ("users": pid -> count), and the index is only read, changed and saved under an flock
+# on index.json.lock, so processes sharing a cache don't lose each other's updates. Users whose process has died (e.g.
+# a crashed worker) don't count. Where fcntl isn't available (Windows), the index is only locked between the threads of
+# one process, so a cache with max_bytes shouldn't be shared by several processes there.
+# Any URL that urllib can open works, including file:// URLs, which makes the cache easy to test offline with a
+# local copy of the bucket layout (see --base-url in the batcher).
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+
+# fcntl is Unix only; without it the index is only locked within the process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Read and hash downloads in 1 MB chunks
+chunk_size = 1024 * 1024
+
+
+def process_alive(pid: int) -> bool:
+    # Whether a process is still running. On Windows, os.kill(pid, 0) would send Ctrl-C (signal 0 is CTRL_C_EVENT), so
+    # ask for the process's exit code instead.
+    if os.name == "nt":
+        # ctypes is only needed on Windows
+        import ctypes
+
+        process_query_limited_information = 0x1000
+        still_active = 259
+        error_access_denied = 5
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        handle = kernel32.OpenProcess(process_query_limited_information, False, pid)
+        if not handle:
+            # No such process, unless it's one we aren't allowed to open
+            return ctypes.get_last_error() == error_access_denied
+        try:
+            exit_code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == still_active
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TileCache:
+    def __init__(self, cache_dir: str, max_bytes: int = None, verify: bool = False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock_path = self.index_path + ".lock"
+        os.makedirs(self.objects_dir, exist_ok=True)
+        # The index is shared by the threads of this process (e.g. a prefetch thread) and by other processes using the
+        # same cache, so only one of them updates it at a time. Downloads happen outside the lock.
+        self.lock = threading.Lock()
+        self._load_index()
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        # Hold the index for reading and changing it: lock it against the other threads and processes, pick up what
+        # they've saved, and save the changes before letting go
+        with self.lock, open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._load_index()
+            yield self.index
+            self._save_index()
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    @staticmethod
+    def make_key(service_type: str, year: int, q: int) -> str:
+        return f"{service_type}/{year}Q{q}"
+
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self.objects_dir, sha256 + ".zip")
+
+    def fetch(self, url: str, service_type: str, year: int, q: int) -> str:
+        # Return a local path to the archive for this service type and quarter, downloading it only if needed
+        # The archive stays in use (and can't be evicted) until it is released
+        key = self.make_key(service_type, year, q)
+        with self._locked_index() as index:
+            entry = index.get(key)
+            cached = entry is not None and entry["url"] == url and self._is_valid(entry)
+            if cached:
+                self._add_user(entry, 1)
+        if cached:
+            print("Using cached", key, "from", self.object_path(entry["sha256"]))
+        else:
+            entry = self._download(url)
+        with self._locked_index() as index:
+            previous = index.get(key)
+            if cached:
+                # This process is already counted in the index's entry, which another process may have replaced with
+                # a new download in the meantime
+                entry = previous or entry
+            else:
+                # Keep the other processes' use of the key, and add this one's
+                entry["users"] = {}
+                if previous is not None:
+                    if previous["sha256"] != entry["sha256"] and not self._in_use(
+                        previous
+                    ):
+                        self._remove_unshared(previous["sha256"], key)
+                    entry["users"] = previous.get("users", {})
+                self._add_user(entry, 1)
+            index[key] = entry
+            entry["last_used"] = time.time()
+            self._evict()
+        return self.object_path(entry["sha256"])
+
+    def release(self, service_type: str, year: int, q: int):
+        # Done with an archive, so it can be evicted again. Evict now, since the cache may be over max_bytes while
+        # it was in use.
+        with self._locked_index() as index:
+            entry = index.get(self.make_key(service_type, year, q))
+            if entry is not None:
+                self._add_user(entry, -1)
+            self._evict()
+
+    @staticmethod
+    def _add_user(entry: dict, count: int):
+        # Count this process as using an entry's archive once more (or, with -1, once less)
+        users = entry.setdefault("users", {})
+        pid = str(os.getpid())
+        users[pid] = users.get(pid, 0) + count
+        if users[pid] <= 0:
+            del users[pid]
+
+    @staticmethod
+    def _in_use(entry: dict) -> bool:
+        # Whether any live process is using an entry's archive. The users of processes that have died are dropped.
+        users = entry.get("users", {})
+        for pid in list(users):
+            if not process_alive(int(pid)):
+                del users[pid]
+        return bool(users)
+
+    def _remove_unshared(self, sha256: str, key: str):
+        # Remove an object that key no longer refers to, unless another key shares it
+        if not any(k != key and e["sha256"] == sha256 for k, e in self.index.items()):
+            path = self.object_path(sha256)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _is_valid(self, entry: dict) -> bool:
+        path = self.object_path(entry["sha256"])
+        if not os.path.exists(path) or os.path.getsize(path) != entry["size"]:
+            return False
+        if self.verify:
+            sha256, _ = self._hash_file(path)
+            if sha256 != entry["sha256"]:
+                print("Cached file", path, "failed its checksum, downloading again.")
+                return False
+        return True
+
+    def _download(self, url: str) -> dict:
+        print("Downloading ", url, "into the cache at", self.cache_dir)
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5()
+        size = 0
+        # Download into a temporary file in the cache directory, so an interrupted download never looks like a cached file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        try:
+            with urllib.request.urlopen(url) as response, os.fdopen(fd, "wb") as f:
+                etag = (response.headers.get("ETag") or "").strip('"') or None
+                while True:
+                    chunk = response.read(chunk_size)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    md5.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            if etag and "-" not in etag and etag != md5.hexdigest():
+                raise IOError(
+                    f"Downloaded {url} does not match its ETag {etag} (md5 {md5.hexdigest()})"
+                )
+            os.replace(tmp_path, self.object_path(sha256.hexdigest()))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return {"url": url, "sha256": sha256.hexdigest(), "etag": etag, "size": size}
+
+    @staticmethod
+    def _hash_file(path: str) -> tuple:
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                size += len(chunk)
+        return sha256.hexdigest(), size
+
+    def _total_bytes(self) -> int:
+        # Objects can be shared by several keys, so count each one once
+        return sum(
+            {entry["sha256"]: entry["size"] for entry in self.index.values()}.values()
+        )
+
+    def _evict(self):
+        # Drop least recently used archives until the cache fits in max_bytes. The archives in use are kept even if
+        # they don't fit in max_bytes on their own.
+        if self.max_bytes is None:
+            return
+        while self._total_bytes() > self.max_bytes:
+            evictable = [k for k, e in self.index.items() if not self._in_use(e)]
+            if not evictable:
+                break
+            key = min(evictable, key=lambda k: self.index[k].get("last_used", 0))
+            entry = self.index.pop(key)
+            self._remove_unshared(entry["sha256"], key)
+            print("Evicted", key, "from the cache.")
+
+    def _save_index(self):
+        # Write the index atomically so a crash can't leave a half-written index behind
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp_path, self.index_path)
@@ -0,0 +1,138 @@
+# Lower-zoom layers of the per-location tiles, written by ookla_data_quadkey_batcher.py (--pyramid-levels).
+#
+# The Ookla tiles are zoom 16 tiles, so a location's GeoJSON file can have hundreds of thousands of them, which is slow
+# for web maps to load when the map is zoomed out. A pyramid layer rolls the tiles up to their parent tiles at a lower
+# zoom level, whose quadkeys are the first level digits of the tiles' quadkeys, e.g. at zoom 12:
+#   quadkey       the parent tile's quadkey
+#   avg_d_kbps    the mean download of the tiles under it, weighted by their tests (likewise avg_u_kbps and avg_lat_ms)
+#   tests         the total tests, and likewise devices
+#   tiles         the number of zoom 16 tiles rolled up into it
+#   geometry      the parent tile's square
+# so the layers can be styled like the full detail files, and a map can load each one at the zooms it's meant for.
+#
+# Only sums are kept per parent (tests, devices, tiles, and the sums of value * tests and of tests for each metric),
+# so the tiles can be rolled up a batch at a time, for the batcher's --stream mode, and give the same layers.
+#
+# Packaging the layers as vector tiles (MBTiles or PMTiles) is left to tools like tippecanoe, which take GeoJSON.
+
+import geopandas as gp
+import numpy as np
+import pandas as pd
+import shapely
+
+from geojson_writer import write_geojson
+from quadkey_index import (
+    encode_quadkeys,
+    keys_to_tiles,
+    max_level,
+    tile_bounds,
+    tiles_to_quadkeys,
+)
+from tile_stats import metric_columns
+
+# Zoom level of the Ookla tiles; the pyramid levels have to be lower
+tile_level = 16
+
+# The sums kept for every parent tile
+sum_columns = ["tiles", "tests", "devices"] + [
+    f"{column}_{total}"
+    for column in metric_columns.values()
+    for total in ["weighted_sum", "weight"]
+]
+
+
+def parent_sums(tiles, level: int) -> pd.DataFrame:
+    # The sums of the tiles under each of their parent tiles at level, indexed by the parents' (right-aligned) keys
+    keys, _ = encode_quadkeys(tiles["quadkey"])
+    parent_keys = keys >> np.uint64(2 * (max_level - level))
+    tests = tiles["tests"].to_numpy(dtype=float)
+    sums = {
+        "tiles": np.ones(len(tiles)),
+        "tests": tests,
+        "devices": tiles["devices"].to_numpy(dtype=float),
+    }
+    for column in metric_columns.values():
+        values = tiles[column].to_numpy(dtype=float)
+        # Like TileStats, leave out missing values
+        valid = ~np.isnan(values)
+        sums[f"{column}_weighted_sum"] = np.where(valid, values * tests, 0.0)
+        sums[f"{column}_weight"] = np.where(valid, tests, 0.0)
+    return (
+        pd.DataFrame(sums, index=pd.Index(parent_keys, name="key"))[sum_columns]
+        .groupby(level=0)
+        .sum()
+    )
+
+
+def merge_sums(sums: pd.DataFrame, other: pd.DataFrame) -> pd.DataFrame:
+    # Add up the sums of two sets of tiles, e.g. two batches
+    if sums is None:
+        return other
+    return pd.concat([sums, other]).groupby(level=0).sum()
+
+
+def rollup_layer(sums: pd.DataFrame, level: int) -> gp.GeoDataFrame:
+    # The pyramid layer at level, from the sums of its parent tiles (see parent_sums)
+    if sums is None:
+        sums = pd.DataFrame(
+            columns=sum_columns, index=pd.Index([], dtype=np.uint64), dtype=float
+        )
+    x, y = keys_to_tiles(sums.index.to_numpy(dtype=np.uint64), level)
+    layer = pd.DataFrame({"quadkey": tiles_to_quadkeys(x, y, level)})
+    for column in metric_columns.values():
+        weight = sums[f"{column}_weight"].to_numpy()
+        layer[column] = np.divide(
+            sums[f"{column}_weighted_sum"].to_numpy(),
+            weight,
+            out=np.full(len(weight), np.nan),
+            where=weight > 0,
+        )
+    for column in ["tests", "devices", "tiles"]:
+        layer[column] = sums[column].to_numpy().astype(np.int64)
+    return gp.GeoDataFrame(
+        layer, geometry=shapely.box(*tile_bounds(x, y, level)), crs="EPSG:4326"
+    )
+
+
+def rollup_tiles(tiles, level: int) -> gp.GeoDataFrame:
+    # Roll tiles up to their parent tiles at level, in one go
+    return rollup_layer(parent_sums(tiles, level), level)
+
+
+class TilePyramidWriter:
+    # Write a location's pyramid layers, one GeoJSON file per level, a batch of tiles at a time. Only the sums of the
+    # parent tiles are kept between batches, and the files are written by close(), like GeoJSONStreamWriter.
+    def __init__(self, filenames: dict, precision: int = None):
+        # filenames is level -> GeoJSON filename
+        self.filenames = filenames
+        self.precision = precision
+        self.sums = {level: None for level in filenames}
+
+    def write(self, tiles):
+        self.add_sums(self.level_sums(tiles))
+
+    def level_sums(self, tiles) -> dict:
+        # The parent tile sums of tiles at each of our levels
+        return {level: parent_sums(tiles, level) for level in self.sums}
+
+    def add_sums(self, sums: dict):
+        # Add sums from level_sums, e.g. to roll the same tiles up into several locations' layers
+        for level in self.sums:
+            self.sums[level] = merge_sums(self.sums[level], sums[level])
+
+    def close(self):
+        for level, filename in self.filenames.items():
+            write_geojson(
+                rollup_layer(self.sums[level], level), filename, self.precision
+            )
+
+    def abort(self):
+        # Nothing has been written yet
+        self.sums = {level: None for level in self.filenames}
+
+
+def write_pyramid(tiles, filenames: dict, precision: int = None):
+    # Write all of tiles' pyramid layers, level -> filename
+    writer = TilePyramidWriter(filenames, precision)
+    writer.write(tiles)
+    writer.close()
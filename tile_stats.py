@@ -0,0 +1,199 @@
+# Mergeable statistics for a set of Ookla tiles, used by ookla_data_quadkey_batcher.py.
+#
+# A TileStats can be updated with any number of batches of tiles, and two TileStats can be merged, e.g. the stats of
+# two batches, two worker processes or two locations. Because everything it keeps is a sum (or a histogram of counts),
+# the result is the same no matter how the tiles were split up, so streaming, parallel and incremental runs all give
+# the same stats. TileStats can also be saved with to_dict and loaded with from_dict, to merge later without
+# re-reading any tiles.
+#
+# For each of download (avg_d_kbps), upload (avg_u_kbps) and latency (avg_lat_ms) it keeps:
+#   count, sum and sum of squares of the tile values, for the mean (as before) and standard deviation of the tiles
+#   sum of value * tests and sum of tests, for the test-weighted mean
+#   a QuantileSketch weighted by tests, for the test-weighted median
+# and overall, the number of tiles and the total tests and devices.
+
+import math
+
+import numpy as np
+
+# stats name -> Ookla column
+metric_columns = {
+    "download": "avg_d_kbps",
+    "upload": "avg_u_kbps",
+    "latency": "avg_lat_ms",
+}
+# The Ookla speeds are in kbps, but we report Mbps
+metric_scale = {"download": 1000, "upload": 1000, "latency": 1}
+
+
+class QuantileSketch:
+    # A small mergeable quantile sketch, in the style of DDSketch (https://arxiv.org/abs/1908.10693).
+    # Positive values go into logarithmically sized buckets, so any quantile is estimated within relative_accuracy
+    # of the true value. Merging adds up the bucket weights, which is exact and does not depend on the order of merges.
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # bucket index -> total weight; bucket i holds values in (gamma^(i-1), gamma^i]
+        self.bins = {}
+        # Weight of values <= 0, which have no logarithm
+        self.zero_weight = 0.0
+
+    def update(self, values: np.ndarray, weights: np.ndarray):
+        positive = values > 0
+        self.zero_weight += float(weights[~positive].sum())
+        indexes = np.ceil(np.log(values[positive]) / self.log_gamma).astype(np.int64)
+        buckets, inverse = np.unique(indexes, return_inverse=True)
+        bucket_weights = np.bincount(inverse, weights=weights[positive])
+        for index, weight in zip(buckets.tolist(), bucket_weights.tolist()):
+            self.bins[index] = self.bins.get(index, 0.0) + weight
+
+    def merge(self, other: "QuantileSketch"):
+        for index, weight in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0.0) + weight
+        self.zero_weight += other.zero_weight
+        return self
+
+    def quantile(self, q: float) -> float:
+        total = self.zero_weight + sum(self.bins.values())
+        if total <= 0:
+            return float("nan")
+        rank = q * total
+        cumulative = self.zero_weight
+        if cumulative > 0 and cumulative >= rank:
+            return 0.0
+        for index in sorted(self.bins):
+            cumulative += self.bins[index]
+            if cumulative >= rank:
+                # The middle of the bucket, in the sense that it is within relative_accuracy of both ends
+                return 2 * self.gamma**index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "zero_weight": self.zero_weight,
+            "bins": {str(index): weight for index, weight in sorted(self.bins.items())},
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "QuantileSketch":
+        sketch = cls(state["relative_accuracy"])
+        sketch.zero_weight = state["zero_weight"]
+        sketch.bins = {int(index): weight for index, weight in state["bins"].items()}
+        return sketch
+
+
+class TileStats:
+    def __init__(self):
+        self.tiles = 0
+        self.tests = 0
+        self.devices = 0
+        self.metrics = {
+            metric: {
+                "count": 0,
+                "sum": 0.0,
+                "sum_sq": 0.0,
+                "weighted_sum": 0.0,
+                "weight": 0.0,
+            }
+            for metric in metric_columns
+        }
+        self.sketches = {metric: QuantileSketch() for metric in metric_columns}
+
+    def update(self, tiles):
+        # Add a dataframe of tiles (with the Ookla columns) to the stats
+        self.tiles += len(tiles)
+        self.tests += int(tiles["tests"].sum())
+        self.devices += int(tiles["devices"].sum())
+        tests = tiles["tests"].to_numpy(dtype=float)
+        for metric, column in metric_columns.items():
+            values = tiles[column].to_numpy(dtype=float)
+            # Like pandas' mean, leave out missing values
+            valid = ~np.isnan(values)
+            values, weights = values[valid], tests[valid]
+            totals = self.metrics[metric]
+            totals["count"] += int(valid.sum())
+            totals["sum"] += float(values.sum())
+            totals["sum_sq"] += float((values**2).sum())
+            totals["weighted_sum"] += float((values * weights).sum())
+            totals["weight"] += float(weights.sum())
+            self.sketches[metric].update(values, weights)
+        return self
+
+    def merge(self, other: "TileStats"):
+        # Add the tiles of another TileStats to this one
+        self.tiles += other.tiles
+        self.tests += other.tests
+        self.devices += other.devices
+        for metric, totals in self.metrics.items():
+            for key in totals:
+                totals[key] += other.metrics[metric][key]
+            self.sketches[metric].merge(other.sketches[metric])
+        return self
+
+    def mean(self, metric: str) -> float:
+        totals = self.metrics[metric]
+        if not totals["count"]:
+            return float("nan")
+        return totals["sum"] / totals["count"] / metric_scale[metric]
+
+    def std(self, metric: str) -> float:
+        totals = self.metrics[metric]
+        if not totals["count"]:
+            return float("nan")
+        mean = totals["sum"] / totals["count"]
+        variance = max(totals["sum_sq"] / totals["count"] - mean**2, 0.0)
+        return math.sqrt(variance) / metric_scale[metric]
+
+    def weighted_mean(self, metric: str) -> float:
+        totals = self.metrics[metric]
+        if not totals["weight"]:
+            return float("nan")
+        return totals["weighted_sum"] / totals["weight"] / metric_scale[metric]
+
+    def median(self, metric: str) -> float:
+        return self.sketches[metric].quantile(0.5) / metric_scale[metric]
+
+    def stats(self) -> dict:
+        # The stats we save for each quarter and location. download, upload and latency are the unweighted means
+        # of the tiles, as they have always been.
+        stats = {
+            "download": self.mean("download"),
+            "upload": self.mean("upload"),
+            "latency": self.mean("latency"),
+            "tests": self.tests,
+            "devices": self.devices,
+            "tiles": self.tiles,
+        }
+        for metric in metric_columns:
+            stats[f"{metric}_weighted"] = self.weighted_mean(metric)
+        for metric in metric_columns:
+            stats[f"{metric}_median"] = self.median(metric)
+        return stats
+
+    def to_dict(self) -> dict:
+        return {
+            "tiles": self.tiles,
+            "tests": self.tests,
+            "devices": self.devices,
+            "metrics": self.metrics,
+            "sketches": {
+                metric: sketch.to_dict() for metric, sketch in self.sketches.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "TileStats":
+        tile_stats = cls()
+        tile_stats.tiles = state["tiles"]
+        tile_stats.tests = state["tests"]
+        tile_stats.devices = state["devices"]
+        tile_stats.metrics = {
+            metric: dict(totals) for metric, totals in state["metrics"].items()
+        }
+        tile_stats.sketches = {
+            metric: QuantileSketch.from_dict(sketch)
+            for metric, sketch in state["sketches"].items()
+        }
+        return tile_stats
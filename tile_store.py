@@ -0,0 +1,192 @@
+# Columnar store of the filtered Ookla tiles, written by ookla_data_quadkey_batcher.py (--tile-store).
+#
+# The tiles for each service type, quarter and location are saved as one GeoParquet file (WKB geometry, zstd
+# compression), in hive-style partition directories:
+#   tile-store/
+#       service=fixed/
+#           quarter=2021Q1/
+#               location=guam/tiles.parquet
+# Parquet is much smaller than GeoJSON and much faster to read back, and any slice of the store can be loaded on its
+# own. GeoJSON (for mapping) can be derived from the store at any time, with export_geojson or from the command line:
+# python tile_store.py --service fixed --quarter 2021Q1 --output-dir geojson-datasets
+# Leave out --service, --quarter or --location to export all of them.
+#
+# TileStoreWriter writes a partition a batch of tiles at a time, for the batcher's --stream mode.
+#
+# Reading and writing GeoParquet needs pyarrow as well as geopandas.
+
+import argparse
+import json
+import os
+
+import geopandas as gp
+import pandas as pd
+
+# Default directory for the store
+store_directory = "tile-store"
+partition_filename = "tiles.parquet"
+
+
+def partition_path(
+    store_dir: str, service_type: str, quarter_year: str, location: str
+) -> str:
+    return os.path.join(
+        store_dir,
+        f"service={service_type}",
+        f"quarter={quarter_year}",
+        f"location={location}",
+        partition_filename,
+    )
+
+
+def write_tiles(
+    tiles: gp.GeoDataFrame,
+    store_dir: str,
+    service_type: str,
+    quarter_year: str,
+    location: str,
+) -> str:
+    # Write (or replace) one partition. We write to a temporary file first, so readers never see a partial file.
+    path = partition_path(store_dir, service_type, quarter_year, location)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    tiles.to_parquet(tmp_path, index=False, compression="zstd")
+    os.replace(tmp_path, path)
+    return path
+
+
+class TileStoreWriter:
+    # Write one partition a batch at a time, so the whole partition never has to be in memory.
+    # Like write_tiles, the partition is only renamed into place when it is complete (by close()).
+    def __init__(
+        self, store_dir: str, service_type: str, quarter_year: str, location: str
+    ):
+        self.path = partition_path(store_dir, service_type, quarter_year, location)
+        self.tmp_path = self.path + ".tmp"
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.writer = None
+
+    def write(self, tiles: gp.GeoDataFrame):
+        # Lazy import, since only this writer uses pyarrow directly
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        geometry_name = tiles.geometry.name
+        table = pa.Table.from_pandas(tiles.to_wkb(), preserve_index=False)
+        if self.writer is None:
+            # GeoParquet metadata for the WKB geometry column. We leave out the bbox and geometry types (both optional),
+            # since they would only describe the first batch.
+            geo = {
+                "version": "1.0.0",
+                "primary_column": geometry_name,
+                "columns": {
+                    geometry_name: {
+                        "encoding": "WKB",
+                        "geometry_types": [],
+                        "crs": tiles.crs.to_json_dict() if tiles.crs else None,
+                    }
+                },
+            }
+            self.schema = table.schema.with_metadata({b"geo": json.dumps(geo)})
+            self.writer = pq.ParquetWriter(
+                self.tmp_path, self.schema, compression="zstd"
+            )
+        self.writer.write_table(table.cast(self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.remove(self.tmp_path)
+
+
+def list_partitions(
+    store_dir: str, service_type: str = None, quarter_year: str = None, location=None
+) -> list:
+    # Return (service_type, quarter_year, location) for every partition in the store that matches the arguments
+    partitions = []
+    if not os.path.isdir(store_dir):
+        return partitions
+    for service_dir in sorted(os.listdir(store_dir)):
+        service = service_dir.partition("=")[2]
+        if service_type is not None and service != service_type:
+            continue
+        for quarter_dir in sorted(os.listdir(os.path.join(store_dir, service_dir))):
+            quarter = quarter_dir.partition("=")[2]
+            if quarter_year is not None and quarter != quarter_year:
+                continue
+            for location_dir in sorted(
+                os.listdir(os.path.join(store_dir, service_dir, quarter_dir))
+            ):
+                loc = location_dir.partition("=")[2]
+                if location is not None and loc != location:
+                    continue
+                if os.path.exists(partition_path(store_dir, service, quarter, loc)):
+                    partitions.append((service, quarter, loc))
+    return partitions
+
+
+def read_tiles(
+    store_dir: str,
+    service_type: str,
+    quarter_year: str = None,
+    location: str = None,
+    columns: list = None,
+) -> gp.GeoDataFrame:
+    # Read one or more partitions into one dataframe. When more than one quarter or location is read, the partition
+    # values are added as "quarter" and "location" columns.
+    partitions = list_partitions(store_dir, service_type, quarter_year, location)
+    if not partitions:
+        raise FileNotFoundError(
+            f"No tiles in {store_dir} for {service_type} {quarter_year or 'all quarters'} {location or 'all locations'}"
+        )
+    if len(partitions) == 1:
+        return gp.read_parquet(partition_path(store_dir, *partitions[0]), columns)
+    frames = []
+    for service, quarter, loc in partitions:
+        tiles = gp.read_parquet(
+            partition_path(store_dir, service, quarter, loc), columns
+        )
+        tiles["quarter"] = quarter
+        tiles["location"] = loc
+        frames.append(tiles)
+    return gp.GeoDataFrame(pd.concat(frames, ignore_index=True))
+
+
+def export_geojson(
+    store_dir: str,
+    service_type: str,
+    quarter_year: str,
+    location: str,
+    geojson_filename: str,
+):
+    # Derive the GeoJSON file for one partition
+    tiles = read_tiles(store_dir, service_type, quarter_year, location)
+    tiles.to_file(geojson_filename, driver="GeoJSON")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export GeoJSON from the tile store.")
+    parser.add_argument("--store-dir", default=store_directory)
+    parser.add_argument("--service", choices=["fixed", "mobile"], default=None)
+    parser.add_argument("--quarter", default=None, help="e.g. 2021Q1")
+    parser.add_argument("--location", default=None, help="e.g. guam")
+    parser.add_argument("--output-dir", default="geojson-datasets")
+    args = parser.parse_args()
+
+    partitions = list_partitions(
+        args.store_dir, args.service, args.quarter, args.location
+    )
+    print("Exporting", len(partitions), "partitions to", args.output_dir)
+    for service, quarter, location in partitions:
+        # Same filenames as the batcher: {output_dir}/{service}/{location}_ookla_{quarter}.geojson
+        os.makedirs(os.path.join(args.output_dir, service), exist_ok=True)
+        geojson_filename = os.path.join(
+            args.output_dir, service, f"{location}_ookla_{quarter}.geojson"
+        )
+        export_geojson(args.store_dir, service, quarter, location, geojson_filename)
+        print("Wrote", geojson_filename)
@@ -0,0 +1,46 @@
+# Streaming reader for the Ookla tile files, used by ookla_data_quadkey_batcher.py (--stream).
+#
+# gp.read_file loads a whole file into one GeoDataFrame, so memory grows with the size of the file. iter_tile_batches
+# instead reads the file through GDAL's Arrow interface, in record batches of at most batch_size tiles, and yields
+# each batch as a small GeoDataFrame. Peak memory then depends on the batch size rather than on the file.
+#
+# It can also leave out the geometry (for the batcher's --geometry-from-quadkeys), and read just the attribute columns
+# into plain DataFrames, which is much faster: GDAL doesn't parse the polygons, and
+# geopandas doesn't make shapely objects out of them. The polygons can be rebuilt from the quadkeys instead (see
+# quadkey_polygons in quadkey_index.py). GDAL's spatial filter needs the geometry, so there's no mask without it.
+#
+# This needs pyogrio and pyarrow as well as geopandas.
+
+import geopandas as gp
+import pyogrio
+
+
+def iter_tile_batches(
+    source: str,
+    batch_size: int,
+    mask=None,
+    read_geometry: bool = True,
+    columns: list = None,
+):
+    # Yield the tiles in source (a path or url, like gp.read_file) as GeoDataFrames of at most batch_size rows.
+    # mask works like the mask of gp.read_file: only tiles that intersect it are read.
+    # With read_geometry=False, yield DataFrames of the attribute columns (or just the given columns) instead.
+    if not read_geometry and mask is not None:
+        raise ValueError("A mask needs the geometry")
+    with pyogrio.open_arrow(
+        source,
+        batch_size=batch_size,
+        mask=mask,
+        read_geometry=read_geometry,
+        columns=columns,
+        use_pyarrow=True,
+    ) as (meta, reader):
+        # Without a named geometry column, GDAL calls it wkb_geometry
+        geometry_name = meta["geometry_name"] or "wkb_geometry"
+        for batch in reader:
+            tiles = batch.to_pandas()
+            if not read_geometry:
+                yield tiles
+                continue
+            geometry = gp.GeoSeries.from_wkb(tiles.pop(geometry_name), crs=meta["crs"])
+            yield gp.GeoDataFrame(tiles, geometry=geometry, crs=meta["crs"])